@@ -4,10 +4,167 @@
 
 import time
 import atexit
+import os
+import random
+import struct
+import types
+from array import array
 
-import pigpio
+try:
+   import pigpio
+except ImportError:
+   pigpio = None
+
+MISSING = 'missing'        # Too few data bits received.
+SHORT = 'short'            # Short message received.
+BAD_CHECKSUM = 'bad_CS'    # Full message with a bad checksum or a bad bit.
+VALID = 'ok'
+
+def tick_diff(t1, t2):
+   """Microseconds from tick t1 to tick t2, the ticks wrap around after 2^32 (same as pigpio.tickDiff)."""
+   return (t2 - t1) & 0xffffffff
+
+def decode(ticks, levels, count):
+   """
+   Decode a captured frame.
+
+   ticks/levels hold the first count edges of the frame. A bit is sent as a
+   high pulse, about 26-28 us for a 0 and 70 us for a 1, and the data bits are
+   the last 40 high pulses of the frame.
+
+   Returns (status, humidity, temperature), the values are None unless the
+   status is VALID.
+   """
+   highs = []
+   rise = None
+   for i in range(count):
+      if levels[i]:
+         rise = ticks[i]
+      elif rise is not None:
+         highs.append(tick_diff(rise, ticks[i]))
+         rise = None
+   # The sensor's 80 us response pulse precedes the data bits.
+   bits = len(highs) - 1
+   if bits < 8:
+      return MISSING, None, None
+   if bits < 40:
+      return SHORT, None, None
+   value = 0
+   for diff in highs[-40:]:
+      if diff >= 200:  # Bad bit?
+         return BAD_CHECKSUM, None, None
+      value = (value << 1) | (diff >= 50)
+   hH, hL, tH, tL, CS = value.to_bytes(5, 'big')
+   if (hH + hL + tH + tL) & 255 != CS:
+      return BAD_CHECKSUM, None, None
+   rhum = ((hH << 8) + hL) * 0.1
+   temp = (((tH & 127) << 8) + tL) * (-0.1 if tH & 128 else 0.1)
+   return VALID, rhum, temp
+
+def encode(rhum, temp, start=0, bits=40, bad_checksum=False, jitter=0, seed=0):
+   """
+   Build the edges [(level, tick), ...] of a frame with the datasheet timings,
+   a stand-in for traces recorded from a real sensor.
+   """
+   h = round(rhum * 10)
+   t = round(abs(temp) * 10) | (0x8000 if temp < 0 else 0)
+   data = [h >> 8, h & 255, t >> 8, t & 255]
+   CS = (sum(data) & 255) ^ (1 if bad_checksum else 0)
+   value = int.from_bytes(bytes(data + [CS]), 'big')
+   rnd = random.Random(seed)
+   edges = []
+   tick = start
+   def pulse(low, high):
+      nonlocal tick
+      edges.append((0, tick & 0xffffffff))
+      tick += low
+      edges.append((1, tick & 0xffffffff))
+      tick += high
+   pulse(17000, 30)  # Host start signal, then released until the sensor answers.
+   pulse(80, 80)     # Sensor response.
+   for i in range(bits):
+      bit = (value >> (39 - i)) & 1
+      pulse(50 + rnd.randint(-jitter, jitter), (70 if bit else 27) + rnd.randint(-jitter, jitter))
+   pulse(50, 0)      # End of frame, the line goes back to idle.
+   return edges[:-1]
+
+# Frames to check the decoder against: description, encode() arguments, expected decode() result.
+TRACES = (
+   ('21.3 C 45.2 %', dict(rhum=45.2, temp=21.3), (VALID, 45.2, 21.3)),
+   ('-4.7 C 88.0 %', dict(rhum=88.0, temp=-4.7), (VALID, 88.0, -4.7)),
+   ('timing jitter', dict(rhum=55.5, temp=19.9, jitter=8, seed=1), (VALID, 55.5, 19.9)),
+   ('tick wraparound', dict(rhum=40.1, temp=25.0, start=2**32 - 9000), (VALID, 40.1, 25.0)),
+   ('bad checksum', dict(rhum=45.2, temp=21.3, bad_checksum=True), (BAD_CHECKSUM, None, None)),
+   ('short message', dict(rhum=45.2, temp=21.3, bits=30), (SHORT, None, None)),
+   ('no answer', dict(rhum=45.2, temp=21.3, bits=0), (MISSING, None, None)),
+)
+
+class fake_pi:
+   """
+   Stand-in for pigpio.pi() replaying frames instead of talking to a sensor.
+
+   Each trigger of the sensor replays the next of the given edge traces to the
+   registered callback, followed by the watchdog timeout.
+   """
+   def __init__(self, traces):
+      self.traces = list(traces)
+      self.callbacks = {}
+      self.armed = set()
+   def write(self, gpio, level):
+      if level == 0 and gpio in self.callbacks:
+         self.armed.add(gpio)
+   def set_mode(self, gpio, mode):
+      pass
+   def set_pull_up_down(self, gpio, pud):
+      pass
+   def set_watchdog(self, gpio, timeout):
+      if not timeout or gpio not in self.armed:
+         return
+      self.armed.discard(gpio)
+      edges = self.traces.pop(0) if self.traces else []
+      func = self.callbacks[gpio]
+      for level, tick in edges:
+         func(gpio, level, tick)
+      func(gpio, pigpio.TIMEOUT, edges[-1][1] if edges else 0)
+   def callback(self, gpio, edge, func):
+      self.callbacks[gpio] = func
+      return types.SimpleNamespace(cancel=lambda: self.callbacks.pop(gpio, None))
+   def stop(self):
+      pass
+
+if pigpio is None:
+   # Enough of pigpio to run the sensor code against fake_pi.
+   pigpio = types.SimpleNamespace(PUD_OFF=0, EITHER_EDGE=2, LOW=0, INPUT=0, TIMEOUT=2, tickDiff=tick_diff)
+
+def selftest(rounds=10000):
+   """Check decode() and the sensor against TRACES and time the decoder, return True if all passed."""
+   passed = True
+   for name, kwargs, expected in TRACES:
+      edges = encode(**kwargs)
+      ticks = array('L', [tick for level, tick in edges])
+      levels = bytearray(level for level, tick in edges)
+      result = decode(ticks, levels, len(edges))
+      ok = result[0] == expected[0] and all(
+         (a is None and b is None) or (a is not None and b is not None and abs(a - b) < 0.05)
+         for a, b in zip(result[1:], expected[1:]))
+      s = sensor(fake_pi([edges]), 4)
+      s.trigger()
+      if expected[0] == VALID:
+         ok = ok and s.tov is not None and abs(s.temperature() - expected[2]) < 0.05
+      s.cancel()
+      passed = passed and ok
+      print('{:<16} {:<8} {}'.format(name, result[0], 'ok' if ok else 'FAILED (expected {})'.format(expected)))
+   edges = encode(45.2, 21.3)
+   ticks = array('L', [tick for level, tick in edges])
+   levels = bytearray(level for level, tick in edges)
+   start = time.perf_counter()
+   for _ in range(rounds):
+      decode(ticks, levels, len(edges))
+   print('decode: {:.1f} us/frame'.format((time.perf_counter() - start) / rounds * 10**6))
+   return passed
 
 class sensor:
+   MAX_EDGES = 128  # A frame has about 86 edges.
    def __init__(self, pi, gpio, LED=None, power=None):
       self.pi = pi
       self.gpio = gpio
@@ -31,83 +188,51 @@ class sensor:
       self.rhum = -999
       self.temp = -999
       self.tov = None
-      self.high_tick = 0
-      self.bit = 40
+      # Edges of the current frame, preallocated so the callback only stores them.
+      self.ticks = array('L', [0]) * self.MAX_EDGES
+      self.levels = bytearray(self.MAX_EDGES)
+      self.edges = 0
       pi.set_pull_up_down(gpio, pigpio.PUD_OFF)
       pi.set_watchdog(gpio, 0)  # Kill any watchdogs.
       self.cb = pi.callback(gpio, pigpio.EITHER_EDGE, self._cb)
    def _cb(self, gpio, level, tick):
-      diff = pigpio.tickDiff(self.high_tick, tick)
-      if level == 0:
-         # Edge length determines if bit is 1 or 0.
-         if diff >= 50:
-            val = 1
-            if diff >= 200:   # Bad bit?
-               self.CS = 256  # Force bad checksum.
-         else:
-            val = 0
-         if self.bit >= 40:  # Message complete.
-            self.bit = 40
-         elif self.bit >= 32:  # In checksum byte.
-            self.CS  = (self.CS << 1)  + val
-            if self.bit == 39:
-               # 40th bit received.
-               self.pi.set_watchdog(self.gpio, 0)
-               self.no_response = 0
-               total = self.hH + self.hL + self.tH + self.tL
-               if (total & 255) == self.CS:  # Is checksum ok?
-                  self.rhum = ((self.hH << 8) + self.hL) * 0.1
-                  if self.tH & 128:  # Negative temperature.
-                     mult = -0.1
-                     self.tH = self.tH & 127
-                  else:
-                     mult = 0.1
-                  self.temp = ((self.tH << 8) + self.tL) * mult
-                  self.tov = time.time()
-                  if self.LED is not None:
-                     self.pi.write(self.LED, 0)
-               else:
-                  self.bad_CS += 1
-         elif self.bit >= 24:  # in temp low byte
-            self.tL = (self.tL << 1) + val
-         elif self.bit >= 16:  # in temp high byte
-            self.tH = (self.tH << 1) + val
-         elif self.bit >= 8:  # in humidity low byte
-            self.hL = (self.hL << 1) + val
-         elif self.bit >= 0:  # in humidity high byte
-            self.hH = (self.hH << 1) + val
-         else:               # header bits
-            pass
-         self.bit += 1
-      elif level == 1:
-         self.high_tick = tick
-         if diff > 250000:
-            self.bit = -2
-            self.hH = 0
-            self.hL = 0
-            self.tH = 0
-            self.tL = 0
-            self.CS = 0
-      else:  # level == pigpio.TIMEOUT:
-         self.pi.set_watchdog(self.gpio, 0)
-         if self.bit < 8:       # Too few data bits received.
-            self.bad_MM += 1    # Bump missing message count.
-            self.no_response += 1
-            if self.no_response > self.MAX_NO_RESPONSE:
-               self.no_response = 0
-               self.bad_SR += 1  # Bump sensor reset count.
-               if self.power is not None:
-                  self.powered = False
-                  self.pi.write(self.power, 0)
-                  time.sleep(2)
-                  self.pi.write(self.power, 1)
-                  time.sleep(2)
-                  self.powered = True
-         elif self.bit < 39:    # Short message receieved.
-            self.bad_SM += 1    # Bump short message count.
-            self.no_response = 0
-         else:                  # Full message received.
+      if level != pigpio.TIMEOUT:
+         if self.edges < self.MAX_EDGES:
+            self.ticks[self.edges] = tick
+            self.levels[self.edges] = level
+            self.edges += 1
+         return
+      # The line has been quiet since the watchdog period, the frame is complete.
+      self.pi.set_watchdog(self.gpio, 0)
+      status, rhum, temp = decode(self.ticks, self.levels, self.edges)
+      self.edges = 0
+      self._frame(status, rhum, temp)
+   def _frame(self, status, rhum, temp):
+      if status == MISSING:
+         self.bad_MM += 1    # Bump missing message count.
+         self.no_response += 1
+         if self.no_response > self.MAX_NO_RESPONSE:
             self.no_response = 0
+            self.bad_SR += 1  # Bump sensor reset count.
+            if self.power is not None:
+               self.powered = False
+               self.pi.write(self.power, 0)
+               time.sleep(2)
+               self.pi.write(self.power, 1)
+               time.sleep(2)
+               self.powered = True
+         return
+      self.no_response = 0
+      if status == SHORT:
+         self.bad_SM += 1    # Bump short message count.
+      elif status == BAD_CHECKSUM:
+         self.bad_CS += 1
+      else:
+         self.rhum = rhum
+         self.temp = temp
+         self.tov = time.time()
+         if self.LED is not None:
+            self.pi.write(self.LED, 0)
    def temperature(self):
       """Return current temperature."""
       return self.temp
@@ -137,22 +262,175 @@ class sensor:
       if self.powered:
          if self.LED is not None:
             self.pi.write(self.LED, 1)
+         self.edges = 0
          self.pi.write(self.gpio, pigpio.LOW)
          time.sleep(0.017)  # 17 ms
          self.pi.set_mode(self.gpio, pigpio.INPUT)
-         self.pi.set_watchdog(self.gpio, 200)
+         # A frame takes about 5 ms, decode it once the line is quiet.
+         self.pi.set_watchdog(self.gpio, 50)
    def cancel(self):
       """Cancel the DHT22 sensor."""
       self.pi.set_watchdog(self.gpio, 0)
       if self.cb is not None:
          self.cb.cancel()
          self.cb = None
+
+class ring:
+   """
+   Readings of a sampler kept in a small file shared with the checks.
+
+   header: magic, capacity, next write position, sampler pid, heartbeat, trigger interval
+   record: sequence, time of measurement, temperature, humidity,
+           bad_CS, bad_SM, bad_MM, bad_SR, sequence again (a torn record has two different ones)
+   """
+   MAGIC = b'DHT1'
+   HEADER = struct.Struct('<4sIIIdd')
+   RECORD = struct.Struct('<Qddd4IQ')
+
+   def __init__(self, path, capacity=32, interval=3.0):
+      self.path = path
+      self.capacity = capacity
+      self.interval = interval
+      self.head = 0
+      self.seq = 0
+      self.fd = None
+   def create(self):
+      """Create an empty ring file, replacing an existing one."""
+      tmp = '{}.{}'.format(self.path, os.getpid())
+      with open(tmp, 'wb') as f:
+         f.write(bytes(self.HEADER.size + self.capacity * self.RECORD.size))
+      os.chmod(tmp, 0o644)
+      os.rename(tmp, self.path)
+      self.fd = os.open(self.path, os.O_WRONLY)
+      self.heartbeat()
+   def heartbeat(self):
+      """Mark the sampler as alive."""
+      os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.capacity, self.head, os.getpid(),
+                                          time.time(), self.interval), 0)
+   def append(self, tov, temp, rhum, bad_CS, bad_SM, bad_MM, bad_SR):
+      """Store a reading."""
+      self.seq += 1
+      os.pwrite(self.fd, self.RECORD.pack(self.seq, tov, temp, rhum, bad_CS, bad_SM, bad_MM, bad_SR, self.seq),
+                self.HEADER.size + self.head * self.RECORD.size)
+      self.head = (self.head + 1) % self.capacity
+      self.heartbeat()
+   def close(self):
+      if self.fd is not None:
+         os.close(self.fd)
+         self.fd = None
+         try:
+            os.unlink(self.path)
+         except OSError:
+            pass
+   @classmethod
+   def read(cls, path):
+      """
+      Return the heartbeat, the trigger interval and the readings (newest first)
+      of a ring file or None if there is none.
+      """
+      try:
+         with open(path, 'rb') as f:
+            data = f.read()
+      except OSError:
+         return None
+      if len(data) < cls.HEADER.size:
+         return None
+      magic, capacity, head, pid, heartbeat, interval = cls.HEADER.unpack_from(data)
+      if magic != cls.MAGIC or len(data) < cls.HEADER.size + capacity * cls.RECORD.size:
+         return None
+      readings = []
+      for i in range(capacity):
+         record = cls.RECORD.unpack_from(data, cls.HEADER.size + ((head - 1 - i) % capacity) * cls.RECORD.size)
+         if record[0] == 0 or record[0] != record[-1]:
+            continue
+         readings.append(record[1:-1])
+      readings.sort(reverse=True)
+      return heartbeat, interval, readings
+
+def trigger_all(sensors, stagger=0.03):
+   """
+   Trigger several sensors one after another.
+
+   trigger() holds the line low for 17 ms and a frame takes about 5 ms, the
+   stagger keeps the frames of the sensors from arriving at the same time.
+   """
+   for i, s in enumerate(sensors):
+      if i:
+         time.sleep(stagger)
+      s.trigger()
+
+def median(values):
+   values = sorted(values)
+   n = len(values)
+   return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+def agreeing(readings, tolerance=(1.0, 5.0)):
+   """Return the (temperature, humidity) readings within tolerance of the median of all readings."""
+   if not readings:
+      return []
+   temp = median([reading[0] for reading in readings])
+   rhum = median([reading[1] for reading in readings])
+   return [reading for reading in readings
+           if abs(reading[0] - temp) <= tolerance[0] and abs(reading[1] - rhum) <= tolerance[1]]
+
+def summarize(readings):
+   """Return median temperature and humidity of the readings without outliers, None if there are no readings."""
+   good = agreeing(readings) or readings
+   if not good:
+      return None
+   return median([reading[0] for reading in good]), median([reading[1] for reading in good])
+
+def collect(sensors, count=3, budget=10.0, spacing=1.2):
+   """
+   Trigger the sensors until each has count agreeing readings or budget seconds have passed.
+
+   Only frames decoded after the trigger count, failed frames leave tov
+   unchanged and the -999 start values are never used.  Returns a list of
+   (temperature, humidity) readings per sensor.
+   """
+   readings = [[] for s in sensors]
+   pending = list(range(len(sensors)))
+   start = time.time()
+   while pending:
+      triggered = time.time()
+      trigger_all([sensors[i] for i in pending])
+      # Frames take about 5 ms plus the 50 ms watchdog, stop waiting once all arrived.
+      wait = triggered + 0.2
+      while time.time() < wait and any(sensors[i].tov is None or sensors[i].tov < triggered for i in pending):
+         time.sleep(0.005)
+      for i in pending:
+         s = sensors[i]
+         if s.tov is not None and s.tov >= triggered:
+            readings[i].append((s.temperature(), s.humidity()))
+      pending = [i for i in pending if len(agreeing(readings[i])) < count]
+      if not pending or triggered + spacing - start >= budget:
+         break
+      time.sleep(max(0, triggered + spacing - time.time()))
+   return readings
+
+def sample(pairs, interval):
+   """Trigger the sensors every interval seconds and store new readings in their rings, pairs are (sensor, ring)."""
+   last_tov = {}
+   deadline = time.time()
+   while True:
+      trigger_all([s for s, r in pairs])
+      time.sleep(0.2)
+      for s, r in pairs:
+         if s.tov is not None and s.tov != last_tov.get(s.gpio):
+            last_tov[s.gpio] = s.tov
+            r.append(s.tov, s.temperature(), s.humidity(),
+                     s.bad_checksum(), s.short_message(), s.missing_message(), s.sensor_resets())
+         else:
+            r.heartbeat()
+      deadline += interval
+      time.sleep(max(0, deadline - time.time()))
+
 if __name__ == "__main__":
     import argparse
+    import re
+    import signal
     import time
     import sys
-    import pigpio
-    import DHT22
 
     def parse_range(value):
         try:
@@ -161,38 +439,115 @@ if __name__ == "__main__":
         except ValueError:
             raise argparse.ArgumentTypeError("Bereich muss im Format min:max angegeben werden, z.B. 18.5:25.0")
 
+    def parse_sensor(value):
+        sensor = {}
+        try:
+            for item in value.split(","):
+                key, val = item.split("=", 1)
+                if key == "pin":
+                    sensor["pin"] = int(val)
+                elif key == "label":
+                    sensor["label"] = val
+                elif key in ("wt", "ct", "wh", "ch"):
+                    sensor[key] = parse_range(val)
+                else:
+                    raise ValueError(key)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Sensor muss im Format pin=4[,label=Name][,wt=min:max][,ct=..][,wh=..][,ch=..] angegeben werden")
+        if "pin" not in sensor:
+            raise argparse.ArgumentTypeError("Sensor ohne pin=")
+        return sensor
+
     # Argumente einlesen
     parser = argparse.ArgumentParser(description="Nagios Plugin für DHT22 mit Schwellwertbereichen")
-    parser.add_argument("-P", "--pin", dest="GPIOpin", type=int, help="GPIO Pin des DHT22 Sensors", required=True)
-    parser.add_argument("-wt", "--warningtemp", dest="wtemp", type=parse_range, help="Warnbereich für Temperatur (min:max)", required=True)
-    parser.add_argument("-ct", "--criticaltemp", dest="ctemp", type=parse_range, help="Kritischer Bereich für Temperatur (min:max)", required=True)
-    parser.add_argument("-wh", "--warninghum", dest="whum", type=parse_range, help="Warnbereich für Luftfeuchtigkeit (min:max)", required=True)
-    parser.add_argument("-ch", "--criticalhum", dest="chum", type=parse_range, help="Kritischer Bereich für Luftfeuchtigkeit (min:max)", required=True)
+    parser.add_argument("-P", "--pin", dest="GPIOpin", type=int, action="append", default=[], help="GPIO Pin des DHT22 Sensors, mehrfach möglich")
+    parser.add_argument("-S", "--sensor", dest="sensors", type=parse_sensor, action="append", default=[],
+                        help="Sensor mit eigener Bezeichnung und eigenen Schwellwerten, z.B. pin=17,label=Rack2,wt=18:27,ct=15:32; "
+                             "fehlende Schwellwerte kommen von -wt/-ct/-wh/-ch")
+    parser.add_argument("-wt", "--warningtemp", dest="wtemp", type=parse_range, help="Warnbereich für Temperatur (min:max)")
+    parser.add_argument("-ct", "--criticaltemp", dest="ctemp", type=parse_range, help="Kritischer Bereich für Temperatur (min:max)")
+    parser.add_argument("-wh", "--warninghum", dest="whum", type=parse_range, help="Warnbereich für Luftfeuchtigkeit (min:max)")
+    parser.add_argument("-ch", "--criticalhum", dest="chum", type=parse_range, help="Kritischer Bereich für Luftfeuchtigkeit (min:max)")
+    parser.add_argument("--daemon", action="store_true", help="Sensoren dauerhaft auslesen und Messwerte für die Checks ablegen")
+    parser.add_argument("--interval", type=float, default=3, help="Sekunden zwischen zwei Messungen im Daemon-Modus (Standard 3)")
+    parser.add_argument("--ring-file", dest="ring_file", default="/dev/shm/check_dht22-{pin}.ring",
+                        help="Ablage der Messwerte, {pin} wird durch den Pin ersetzt (Standard /dev/shm/check_dht22-{pin}.ring)")
+    parser.add_argument("--max-age", dest="max_age", type=float, default=60, help="Maximales Alter der Messwerte des Daemons in Sekunden (Standard 60)")
+    parser.add_argument("--samples", type=int, default=3, help="Anzahl übereinstimmender Messwerte je Sensor (Standard 3)")
+    parser.add_argument("--timeout", type=float, default=10, help="Maximale Dauer der direkten Messung in Sekunden (Standard 10)")
+    parser.add_argument("--selftest", action="store_true", help="Dekodierung ohne Sensor mit aufgezeichneten Flanken prüfen und messen")
     args = parser.parse_args()
+    if args.samples < 1:
+        parser.error("--samples muss mindestens 1 sein")
+    if args.selftest:
+        # Läuft ohne Sensor und ohne pigpio
+        sys.exit(0 if selftest() else 1)
+
+    sensors = [{"pin": pin} for pin in args.GPIOpin] + args.sensors
+    if not sensors:
+        parser.error("-P oder -S ist erforderlich")
+    if len({conf["pin"] for conf in sensors}) != len(sensors):
+        parser.error("Jeder Pin darf nur einmal angegeben werden")
+    if len(sensors) > 1 and "{pin}" not in args.ring_file:
+        parser.error("--ring-file muss bei mehreren Sensoren {pin} enthalten")
+    for conf in sensors:
+        for key, default in (("wt", args.wtemp), ("ct", args.ctemp), ("wh", args.whum), ("ch", args.chum)):
+            conf.setdefault(key, default)
+        if not args.daemon and None in (conf["wt"], conf["ct"], conf["wh"], conf["ch"]):
+            parser.error("-wt, -ct, -wh und -ch sind erforderlich (Pin {})".format(conf["pin"]))
+        conf["ring"] = args.ring_file.replace("{pin}", str(conf["pin"]))
+    if not hasattr(pigpio, "pi"):
+        print("UNKNOWN - Python-Modul pigpio ist nicht installiert")
+        sys.exit(3)
 
-    # Sensor einrichten
-    INTERVAL = 3
-    pi = pigpio.pi()
-    s = DHT22.sensor(pi, args.GPIOpin, LED=16, power=8)
+    def setup(pi, pins):
+        # Alle Sensoren hängen an derselben Versorgung (Pin 8), sie wird nur einmal eingeschaltet
+        return [sensor(pi, pin, LED=16, power=8 if i == 0 else None) for i, pin in enumerate(pins)]
 
-    # 3 Messwerte sammeln
-    temperatures = []
-    humidities = []
+    if args.daemon:
+        # Sensoren über eine gemeinsame pigpio-Verbindung dauerhaft auslesen
+        pi = pigpio.pi()
+        pairs = []
+        for s, conf in zip(setup(pi, [conf["pin"] for conf in sensors]), sensors):
+            r = ring(conf["ring"], interval=args.interval)
+            r.create()
+            pairs.append((s, r))
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            sample(pairs, args.interval)
+        finally:
+            for s, r in pairs:
+                r.close()
+                s.cancel()
+            pi.stop()
 
-    for i in range(3):
-        s.trigger()
-        time.sleep(0.2)
-        temperatures.append(s.temperature())
-        humidities.append(s.humidity())
-        time.sleep(1)
+    # Messwerte des Daemons verwenden, solange er läuft
+    direct = []
+    for conf in sensors:
+        conf["readings"] = []
+        conf["age"] = None
+        stored = ring.read(conf["ring"])
+        if stored is None or time.time() - stored[0] >= max(5 * stored[1], 30):
+            direct.append(conf)
+            continue
+        heartbeat, interval, readings = stored
+        fresh = [reading for reading in readings if time.time() - reading[0] <= args.max_age]
+        if not fresh:
+            conf["last"] = "{:.0f}s".format(time.time() - readings[0][0]) if readings else "nie"
+            continue
+        # Die letzten Messwerte verwenden
+        conf["readings"] = [(temp, rhum) for tov, temp, rhum, bad_CS, bad_SM, bad_MM, bad_SR in fresh[:args.samples]]
+        conf["age"] = time.time() - fresh[0][0]
 
-    # Durchschnitt berechnen
-    average_temp = sum(temperatures) / len(temperatures)
-    average_hum = sum(humidities) / len(humidities)
+    if direct:
+        # Sensoren einrichten, eine gemeinsame pigpio-Verbindung für alle
+        pi = pigpio.pi()
+        sensor_objs = setup(pi, [conf["pin"] for conf in direct])
 
-    # Status bestimmen
-    status = "OK"
-    exit_code = 0
+        # Messen, bis jeder Sensor genug übereinstimmende gültige Messwerte hat oder die Zeit abgelaufen ist
+        for readings, conf in zip(collect(sensor_objs, args.samples, args.timeout), direct):
+            conf["readings"] = readings
+            conf["last"] = None
 
     def check_range(value, warn_range, crit_range):
         if value < crit_range[0] or value > crit_range[1]:
@@ -202,19 +557,39 @@ if __name__ == "__main__":
         else:
             return "OK", 0
 
-    temp_status, temp_code = check_range(average_temp, args.wtemp, args.ctemp)
-    hum_status, hum_code = check_range(average_hum, args.whum, args.chum)
+    # Mit Bezeichnung ausgeben, sobald mehr als ein Sensor geprüft wird
+    labelled = len(sensors) > 1 or any("label" in conf for conf in sensors)
+    exit_code = 0
+    texts = []
+    perfdata = []
+    for conf in sensors:
+        name = conf.get("label", "GPIO{}".format(conf["pin"]))
+        prefix = f"{name}: " if labelled else ""
+        perf_prefix = re.sub(r"\W+", "_", name) + "_" if labelled else ""
+        # Median ohne Ausreißer berechnen
+        result = summarize(conf["readings"])
+        if result is None:
+            if conf["last"] is None:
+                texts.append(f"{prefix}Keine gültigen Messwerte vom Sensor innerhalb von {args.timeout:g}s")
+            else:
+                texts.append(f"{prefix}Keine aktuellen Messwerte vom Daemon (letzter Messwert: {conf['last']})")
+            exit_code = max(exit_code, 3)
+            continue
+        temp, hum = result
+
+        temp_status, temp_code = check_range(temp, conf["wt"], conf["ct"])
+        hum_status, hum_code = check_range(hum, conf["wh"], conf["ch"])
+        exit_code = max(exit_code, temp_code, hum_code)
+
+        texts.append(f"{prefix}Temperatur: {temp:.2f}°C, Luftfeuchtigkeit: {hum:.2f}%")
+        perfdata.append(f"{perf_prefix}temperature={temp:.2f};{conf['wt'][0]}:{conf['wt'][1]};{conf['ct'][0]}:{conf['ct'][1]};0;200")
+        perfdata.append(f"{perf_prefix}humidity={hum:.2f};{conf['wh'][0]}:{conf['wh'][1]};{conf['ch'][0]}:{conf['ch'][1]};0;100")
+        if conf["age"] is not None:
+            perfdata.append(f"{perf_prefix}age={conf['age']:.1f}s")
 
     # Schlimmsten Status wählen
-    if 2 in [temp_code, hum_code]:
-        status = "CRITICAL"
-        exit_code = 2
-    elif 1 in [temp_code, hum_code]:
-        status = "WARNING"
-        exit_code = 1
+    status = {0: "OK", 1: "WARNING", 2: "CRITICAL", 3: "UNKNOWN"}[exit_code]
 
     # Ausgabe
-    print(f"{status} - Temperatur: {average_temp:.2f}°C, Luftfeuchtigkeit: {average_hum:.2f}% | "
-          f"temperature={average_temp:.2f};{args.wtemp[0]}:{args.wtemp[1]};{args.ctemp[0]}:{args.ctemp[1]};0;200 "
-          f"humidity={average_hum:.2f};{args.whum[0]}:{args.whum[1]};{args.chum[0]}:{args.chum[1]};0;100")
+    print(f"{status} - " + "; ".join(texts) + (" | " + " ".join(perfdata) if perfdata else ""))
     sys.exit(exit_code)
@@ -3,6 +3,8 @@
 
 
 import sys, socket, argparse, json, requests, urllib3, ipaddress, logging
+import fcntl, hashlib, os, tempfile, time
+from datetime import datetime
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from optparse import OptionParser, OptionGroup
 
@@ -20,6 +22,19 @@ headers = {
     'Content-Type': 'application/json',
 }
 
+# connect and read timeout for the graylog API, set from --connect-timeout and --read-timeout
+TIMEOUT = (5, 30)
+# sessions are renewed this many seconds before graylog expires them
+SESSION_MARGIN = 60
+
+# shared by the session login and the alert search, the search reuses the login connection
+http_session = requests.Session()
+http_session.verify = False
+
+
+class SessionInvalid(Exception):
+    pass
+
 def search_graylog_for_alerts(headers, session_id, host, query, machine, timerange, crit, warn, result,proto):
 
     base = (proto +"://" + host+ ":9000/api/events/search")
@@ -27,7 +42,9 @@ def search_graylog_for_alerts(headers, session_id, host, query, machine, timeran
 
     data = '{"sort_direction": "desc", "timerange": { "type": "relative", "from" : "'+timerange+'"},  "query": "'+query+'",  "sort_by": "timestamp"}'
 
-    searching = requests.post(base, headers=headers, data=data, verify=False, auth=(session_id, 'session'))
+    searching = http_session.post(base, headers=headers, data=data, auth=(session_id, 'session'), timeout=TIMEOUT)
+    if searching.status_code == 401:
+        raise SessionInvalid("session "+session_id+" was refused")
     result = []
     resultJson = searching.json()
     for events in resultJson['events']:
@@ -64,37 +81,86 @@ def unpackGraylogKeys(*args):
     return(','.join(args))
 
 
-def create_session(headers, host,user,password):
-    # create session id for api request
+def parse_valid_until(valid_until):
+    # graylog answers e.g. 2024-05-02T10:15:00.000+0000, returns epoch seconds or 0 if unknown
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z"):
+        try:
+            return datetime.strptime(str(valid_until).replace("Z", "+0000"), fmt).timestamp()
+        except ValueError:
+            pass
+    return 0
 
-    base = ("https://" + host+ ":9000/api/system/sessions")
+
+def post_session(headers, host, user, password, proto):
+    base = (proto + "://" + host+ ":9000/api/system/sessions")
     LOGGER.debug("Using "+ base+ " in order to create session id ")
-    proto = "https"
-    data = '{"username":"'+user+'", "password":"'+password+'", "host":""}'
-    try:
-     session = requests.post(base, headers=headers, data=data, verify=False)
-     session = session.json()
-     session_id = session['session_id']
-     LOGGER.debug("Successfully created session_id "+ str(session['session_id']))
-     LOGGER.debug("Valid until " + str(session['valid_until']))
-    except Exception as ex:
-     LOGGER.debug(ex)
-     try:
-      base = ("http://" + host+ ":9000/api/system/sessions")
-      LOGGER.debug("https did not work. Using "+ base+ " instead")
-      proto="http"
-      data = '{"username":"'+user+'", "password":"'+password+'", "host":""}'
-      session = requests.post(base, headers=headers, data=data)
-      session = session.json()
-      session_id = session['session_id']
-      LOGGER.debug("Successfully created session_id "+ str(session['session_id']))
-      LOGGER.debug("Valid until " + str(session['valid_until']))
-     except Exception as ex:
-      LOGGER.debug(ex)
-      LOGGER.debug("ERROR: Could not create session_id!")
-      exit(2)
+    data = json.dumps({"username": user, "password": password, "host": ""})
+    session = http_session.post(base, headers=headers, data=data, timeout=TIMEOUT)
+    session = session.json()
+    LOGGER.debug("Successfully created session_id "+ str(session['session_id']))
+    LOGGER.debug("Valid until " + str(session['valid_until']))
+    return session['session_id'], parse_valid_until(session['valid_until'])
+
+
+def create_session(headers, host,user,password, proto=None):
+    # create session id for api request, trying https first and http after it unless the protocol is known
+    error = None
+    for proto in ([proto] if proto else ["https", "http"]):
+        try:
+            session_id, valid_until = post_session(headers, host, user, password, proto)
+            return proto, session_id, valid_until
+        except Exception as ex:
+            LOGGER.debug(ex)
+            LOGGER.debug(proto + " did not work")
+            error = ex
+    raise requests.ConnectionError("could not create session over https or http") from error
+
+
+def cached_session(headers, host, user, password, cache_file, proto_ttl, renew=False):
+    # reuse session id and protocol of earlier runs, the session until shortly before it expires
+    # and the protocol for proto_ttl seconds, so the https -> http probe runs once per period
+    key = hashlib.sha256((host + "\0" + user + "\0" + password).encode()).hexdigest()
+    with open(cache_file + ".lock", "a") as lock:
+        # checks starting at the same time wait for the first one instead of all logging in
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        if not isinstance(cache, dict):
+            cache = {}
+        entry = cache.get(key) or {}
+        now = time.time()
+        if not renew and entry.get("session_id") and entry.get("valid_until", 0) - SESSION_MARGIN > now:
+            LOGGER.debug("Reusing session_id valid until " + time.ctime(entry["valid_until"]))
+            return entry["proto"], entry["session_id"]
+
+        if entry.get("proto") and entry.get("proto_checked", 0) + proto_ttl > now:
+            proto = entry["proto"]
+            try:
+                session_id, valid_until = post_session(headers, host, user, password, proto)
+            except Exception as ex:
+                # graylog may have changed its protocol, probe the other one instead of
+                # waiting for a hanging port twice
+                LOGGER.debug(ex)
+                proto, session_id, valid_until = create_session(headers, host, user, password, "http" if proto == "https" else "https")
+                entry["proto_checked"] = now
+        else:
+            proto, session_id, valid_until = create_session(headers, host, user, password)
+            entry["proto_checked"] = now
+        entry.update(proto=proto, session_id=session_id, valid_until=valid_until)
 
-    return proto,session['session_id']
+        cache = {k: v for k, v in cache.items() if max(v.get("valid_until", 0), v.get("proto_checked", 0) + proto_ttl) > now}
+        cache[key] = entry
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(cache_file)), delete=False) as f:
+                os.fchmod(f.fileno(), 0o600)
+                json.dump(cache, f)
+            os.replace(f.name, cache_file)
+        except OSError as ex:
+            LOGGER.debug(ex)
+        return proto, session_id
 
 
 
@@ -144,6 +210,15 @@ if __name__ == "__main__":
         #-t / --time
         time_opts.add_option("-t", "--time", dest="timerange", action="store", default="86400", metavar="TIMERANGE", type="string", help="timerange since now in seconds (default 86400)")
 
+        #--session-cache / --no-session-cache / --proto-cache-ttl
+        gen_opts.add_option("--session-cache", dest="session_cache", default=os.path.join(tempfile.gettempdir(), "check_graylog_alerts-"+str(os.getuid())+".json"), action="store", metavar="FILE", help="file keeping session id and protocol between runs")
+        gen_opts.add_option("--no-session-cache", dest="no_session_cache", default=False, action="store_true", help="create a new session and probe the protocol on every run")
+        gen_opts.add_option("--proto-cache-ttl", dest="proto_cache_ttl", default=3600, action="store", type="float", metavar="SECONDS", help="seconds the detected protocol is reused (default 3600)")
+
+        #--connect-timeout / --read-timeout
+        gen_opts.add_option("--connect-timeout", dest="connect_timeout", default=TIMEOUT[0], action="store", type="float", metavar="SECONDS", help="timeout for connecting to graylog (default 5)")
+        gen_opts.add_option("--read-timeout", dest="read_timeout", default=TIMEOUT[1], action="store", type="float", metavar="SECONDS", help="timeout for graylog answers (default 30)")
+
         #parse arguments
         (options, args) = parser.parse_args()
 
@@ -165,8 +240,24 @@ if __name__ == "__main__":
           logging.basicConfig()
           LOGGER.setLevel(logging.INFO)
 
-        proto,session_id = create_session(headers, host, user, password)
-        result,crit = search_graylog_for_alerts(headers, session_id, host, query, machine, timerange, crit, warn, result, proto)
+        TIMEOUT = (options.connect_timeout, options.read_timeout)
+        try:
+            if options.no_session_cache:
+                proto,session_id,valid_until = create_session(headers, host, user, password)
+                result,crit = search_graylog_for_alerts(headers, session_id, host, query, machine, timerange, crit, warn, result, proto)
+            else:
+                proto,session_id = cached_session(headers, host, user, password, options.session_cache, options.proto_cache_ttl)
+                try:
+                    result,crit = search_graylog_for_alerts(headers, session_id, host, query, machine, timerange, crit, warn, result, proto)
+                except (SessionInvalid, requests.RequestException) as ex:
+                    # the cached session_id was refused or the search failed, log in again,
+                    # cached_session falls back to the other protocol if the cached one is down
+                    LOGGER.debug(ex)
+                    proto,session_id = cached_session(headers, host, user, password, options.session_cache, options.proto_cache_ttl, renew=True)
+                    result,crit = search_graylog_for_alerts(headers, session_id, host, query, machine, timerange, crit, warn, result, proto)
+        except (SessionInvalid, requests.RequestException) as ex:
+            print("UNKNOWN. Could not search graylog for alerts: " + str(ex))
+            sys.exit(3)
         if crit == 1:
             print(result)
             sys.exit(2)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# All Xen Orchestra checks in one run
+#
+# Signs in once, walks SRs, pools and hosts once and hands one result per
+# object to Icinga as passive check results, either through the Icinga 2 API
+# (process-check-result over one keep-alive session) or as external commands
+# in a spool file or the command pipe. The SR and patch evaluation is the one
+# of check_xoa_srs.py and check_xoa_pools_patches.py. The run itself is
+# reported like a normal check.
+
+import fcntl
+import os
+import socket
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from optparse import OptionParser
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import check_xoa_pools_patches as Patches
+import check_xoa_srs as Srs
+from xoa_client import XoClient, XoError, readSnapshot
+
+#    User Vars
+ExcludeTag = 'no_monitoring'
+Debug = False
+
+#    Script Vars - do not edit
+XoResults       = []
+XoFailed        = []
+
+Timeout = 20
+
+HostStates = {'Running': 0, 'Suspended': 1, 'Halted': 2}
+StatusNames = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+
+
+def addResult(Service, Code, Text, PerfData = None):
+    XoResults.append((Service, Code, StatusNames[Code] + ' - ' + Text, PerfData or []))
+
+def submitIcinga(Results, Options):
+    # Icinga 2 takes one result per call, the calls share one pooled keep-alive session
+    Session = requests.Session()
+    Session.auth = (Options.icinga_user, Options.icinga_password)
+    Session.headers['Accept'] = 'application/json'
+    Session.verify = Options.icinga_ca or not Options.insecure
+    Adapter = HTTPAdapter(pool_connections=Options.icinga_workers, pool_maxsize=Options.icinga_workers)
+    Session.mount('https://', Adapter)
+    Session.mount('http://', Adapter)
+    Url = Options.icinga_url.rstrip('/') + '/v1/actions/process-check-result'
+    CheckSource = socket.getfqdn()
+
+    def submit(Result):
+        Service, Code, Text, PerfData = Result
+        try:
+            req = Session.post(Url, params={'service': Options.icinga_host + '!' + Service}, timeout=Timeout,
+                               json={'type': 'Service', 'exit_status': Code, 'plugin_output': Text,
+                                     'performance_data': PerfData, 'check_source': CheckSource})
+            req.raise_for_status()
+        except requests.RequestException as ex:
+            debugPrint(Service + ': ' + str(ex))
+            XoFailed.append(Service)
+
+    with ThreadPoolExecutor(max_workers=Options.icinga_workers) as Submitter:
+        list(Submitter.map(submit, Results))
+    Session.close()
+
+def submitSpool(Results, Options):
+    # External command lines, into the command pipe, a new file in a spool directory or appended to a file
+    Now = int(time.time())
+    Lines = ''.join('[' + str(Now) + '] PROCESS_SERVICE_CHECK_RESULT;' + Options.icinga_host + ';' + Service + ';' + str(Code) + ';'
+                    + Text.replace('\n', ' ').replace('|', '/') + ('|' + ' '.join(PerfData) if PerfData else '') + '\n'
+                    for Service, Code, Text, PerfData in Results)
+    try:
+        if os.path.isdir(Options.spool):
+            with tempfile.NamedTemporaryFile('w', dir=Options.spool, prefix='.xoa-', delete=False) as f:
+                f.write(Lines)
+            os.replace(f.name, os.path.join(Options.spool, 'xoa-' + str(Now) + '-' + str(os.getpid()) + '.cmd'))
+        elif os.path.exists(Options.spool) and stat.S_ISFIFO(os.stat(Options.spool).st_mode):
+            with open(Options.spool, 'w') as f:
+                f.write(Lines)
+        else:
+            with open(Options.spool, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(Lines)
+    except OSError as ex:
+        debugPrint(str(ex))
+        XoFailed.extend(Service for Service, Code, Text, PerfData in Results)
+
+def debugPrint(Text):
+    if Debug == True:
+        print('[DEBUG] ' + Text)
+
+def parse_opts():
+    parser = OptionParser()
+    parser.add_option("--protocol")
+    parser.add_option("--url")
+    parser.add_option("--token")
+    parser.add_option("--retries", type="int", default=2, help="retries for timeouts and 5xx answers (default 2)")
+    parser.add_option("--snapshot", help="read everything from this xoa_events.py snapshot instead of the REST API")
+    parser.add_option("--snapshot-max-age", dest="snapshot_max_age", type="float", default=120,
+                      help="snapshots older than this many seconds are UNKNOWN (default 120)")
+    parser.add_option("--warning", default="80", help="SR usage in percent (default 80)")
+    parser.add_option("--critical", default="90", help="SR usage in percent (default 90)")
+    parser.add_option("--history-dir", dest="history_dir", help="usage history of the SRs, see check_xoa_srs.py")
+    parser.add_option("--warning-eta", dest="warning_eta", type="float", help="days until an SR is full")
+    parser.add_option("--critical-eta", dest="critical_eta", type="float", help="days until an SR is full")
+    parser.add_option("--workers", type="int", default=8, help="pools fetched at the same time (default 8)")
+    parser.add_option("--deadline", type="float", default=50, help="seconds after which unfinished pools are UNKNOWN (default 50)")
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="int", default=0, help="missing patch cache, see check_xoa_pools_patches.py")
+    parser.add_option("--cache-dir", dest="cache_dir")
+    parser.add_option("--icinga-host", dest="icinga_host", help="Icinga host object the services belong to (default --url)")
+    parser.add_option("--sr-service", dest="sr_service", default="SR {name}", help="service name of an SR (default 'SR {name}')")
+    parser.add_option("--pool-service", dest="pool_service", default="Patches {name}", help="service name of a pool (default 'Patches {name}')")
+    parser.add_option("--host-service", dest="host_service", default="Host {name}", help="service name of a host (default 'Host {name}')")
+    parser.add_option("--icinga-url", dest="icinga_url", help="Icinga 2 API, e.g. https://icinga.example.com:5665")
+    parser.add_option("--icinga-user", dest="icinga_user")
+    parser.add_option("--icinga-password", dest="icinga_password")
+    parser.add_option("--icinga-ca", dest="icinga_ca", help="CA certificate of the Icinga 2 API")
+    parser.add_option("--icinga-workers", dest="icinga_workers", type="int", default=8, help="results submitted at the same time (default 8)")
+    parser.add_option("--insecure", action="store_true", help="do not verify the certificate of the Icinga 2 API")
+    parser.add_option("--spool", help="write external commands to this command pipe, spool directory or file instead")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    (options, args) = parse_opts()
+    if not options.icinga_url and not options.spool:
+        print('UNKNOWN - --icinga-url or --spool is required')
+        exit(3)
+    if options.icinga_host is None:
+        options.icinga_host = str(options.url)
+
+    Start = time.monotonic()
+    Client = XoClient(options.protocol, options.url, options.token, Timeout=Timeout, Retries=options.retries, PoolSize=options.workers)
+
+    # The checks evaluate with their module settings
+    Srs.Client = Patches.Client = Client
+    Srs.TresholdWarn = options.warning
+    Srs.TresholdCrit = options.critical
+    Srs.HistoryDir = options.history_dir
+    Srs.EtaWarn = options.warning_eta
+    Srs.EtaCrit = options.critical_eta
+    if options.history_dir:
+        os.makedirs(options.history_dir, mode=0o700, exist_ok=True)
+    Patches.Deadline = Start + options.deadline
+    Patches.CacheTtl = options.cache_ttl
+    Patches.CacheDir = options.cache_dir or os.path.join(tempfile.gettempdir(), 'check_xoa_pools_patches-' + str(options.url).replace('/', '_'))
+    if options.cache_ttl > 0:
+        os.makedirs(Patches.CacheDir, mode=0o700, exist_ok=True)
+
+    try:
+        if options.snapshot:
+            XoSnapshot = readSnapshot(options.snapshot, options.snapshot_max_age)
+            XoSrs = list(XoSnapshot['objects'].get('SR', {}).values())
+            XoPools = list(XoSnapshot['objects'].get('pool', {}).values())
+            XoHosts = list(XoSnapshot['objects'].get('host', {}).values())
+        else:
+            XoSrs = Client.get('/srs', Fields=['name_label', '$container', 'size', 'usage', 'id', 'physical_usage', 'content_type', 'SR_type', 'tags'])
+            XoPools = Client.get('/pools', Fields=['id', 'name_label', 'tags'])
+            XoHosts = Client.get('/hosts', Fields=['id', 'name_label', 'power_state', 'tags'])
+    except XoError as ex:
+        print('UNKNOWN - Error while getting Data: ' + str(ex))
+        exit(3)
+    # The SR containers are among the pools and hosts just fetched, excluded ones as well
+    Srs.XoContainerNames = {
+        'pools': {str(pool['id']): str(pool['name_label']) for pool in XoPools},
+        'hosts': {str(host['id']): str(host['name_label']) for host in XoHosts},
+    }
+    XoSrs = [sr for sr in XoSrs if ExcludeTag not in sr.get('tags', [])]
+    XoPools = [pool for pool in XoPools if ExcludeTag not in pool.get('tags', [])]
+    XoHosts = [host for host in XoHosts if ExcludeTag not in host.get('tags', [])]
+
+    # Missing patches, from the snapshot or concurrently under the deadline
+    XoPatchResults = {}
+    if options.snapshot:
+        for pool in XoPools:
+            Entry = XoSnapshot.get('missing_patches', {}).get(str(pool['id']))
+            XoPatchResults[str(pool['id'])] = int(Entry['count']) if Entry else XoError('no patch data in snapshot yet')
+    else:
+        if options.cache_ttl > 0:
+            for pool in XoPools:
+                Cached = Patches.readCache(str(pool['id']))
+                if Cached is not None and time.time() - Cached[0] < options.cache_ttl:
+                    XoPatchResults[str(pool['id'])] = Cached[1]
+        Executor = ThreadPoolExecutor(max_workers=options.workers)
+        Futures = {str(pool['id']): Executor.submit(Patches.getMissingPatches, str(pool['id'])) for pool in XoPools if str(pool['id']) not in XoPatchResults}
+        Done, NotDone = wait(Futures.values(), timeout=max(0, Patches.Deadline - time.monotonic()))
+        Executor.shutdown(wait=False, cancel_futures=True)
+        for PoolId, Future in Futures.items():
+            if Future not in Done:
+                XoPatchResults[PoolId] = XoError('deadline reached')
+                continue
+            try:
+                XoPatchResults[PoolId] = Future.result()[0]
+            except XoError as ex:
+                XoPatchResults[PoolId] = ex
+
+    for lis in XoSrs:
+        status, percent, SrPerfData, SrText = Srs.checkSR(lis, Labelled=False)
+        Code = {'OK': 0, 'Warning': 1, 'Critical': 2}[status]
+        addResult(options.sr_service.format(name=lis['name_label'], id=lis['id']), Code,
+                  SrText or (str(percent) + '% used'), SrPerfData)
+    for pool in XoPools:
+        Service = options.pool_service.format(name=pool['name_label'], id=pool['id'])
+        MissingPatches = XoPatchResults[str(pool['id'])]
+        if isinstance(MissingPatches, XoError):
+            addResult(Service, 3, 'Error while getting Data: ' + str(MissingPatches))
+        else:
+            addResult(Service, 2 if MissingPatches else 0, 'Missing patches: ' + str(MissingPatches),
+                      ['missing_patches=' + str(MissingPatches) + ';;0;0'])
+    for host in XoHosts:
+        PowerState = str(host.get('power_state'))
+        addResult(options.host_service.format(name=host['name_label'], id=host['id']), HostStates.get(PowerState, 3), 'Power state: ' + PowerState)
+
+    if options.spool:
+        submitSpool(XoResults, options)
+    else:
+        submitIcinga(XoResults, options)
+
+    Duration = time.monotonic() - Start
+    XoPerfText = (' | results=' + str(len(XoResults)) + ' srs=' + str(len(XoSrs)) + ' pools=' + str(len(XoPools)) + ' hosts=' + str(len(XoHosts))
+                  + ' failed=' + str(len(XoFailed)) + ' duration=' + '{:.3f}'.format(Duration) + 's')
+    # Patch requests still running after the deadline must not hold up the exit
+    Exit = os._exit if not options.snapshot and NotDone else exit
+    if XoFailed:
+        print('CRITICAL - ' + str(len(XoFailed)) + ' of ' + str(len(XoResults)) + ' results not submitted: ' + str(XoFailed[:10]) + XoPerfText, flush=True)
+        Exit(2)
+    print('OK - ' + str(len(XoResults)) + ' results submitted' + XoPerfText, flush=True)
+    Exit(0)
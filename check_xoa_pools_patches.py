@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
-import requests
+import fcntl
 import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import optparse
 from optparse import OptionParser
+from xoa_client import XoClient, XoError, readSnapshot
 
 #    User Vars
-XoApiUri     = '/rest/v0'
 Debug = False
 
 #    Script Vars - do not edit
@@ -14,32 +21,86 @@ XoServerUrl     = ''
 XoAuthToken     = ''
 
 XoCritPools     = []
+XoUnknownPools  = []
+XoPerfData      = []
 XoOutputText    = ''
 
 Timeout = 20
+Deadline = 0
+
+CacheTtl        = 0
+CacheMaxStale   = 0
+CacheDir        = ''
+# Hands the token to the refresh process, its command line is readable by every local user
+TokenEnv        = 'CHECK_XOA_POOLS_PATCHES_TOKEN'
+
+
+def getMissingPatches(PoolId):
+    # Runs in the worker pool, no request may outlast the global deadline
+    Start = time.monotonic()
+    Remaining = Deadline - Start
+    if Remaining <= 0:
+        raise XoError('Deadline reached')
+    XoPoolsDetailsMissingPatchesJsonList = Client.get('/pools/' + PoolId + '/missing_patches', Timeout=min(Timeout, Remaining))
+    if CacheTtl > 0:
+        writeCache(PoolId, len(XoPoolsDetailsMissingPatchesJsonList))
+    return len(XoPoolsDetailsMissingPatchesJsonList), time.monotonic() - Start
+
+def cachePath(PoolId):
+    return os.path.join(CacheDir, PoolId.replace('/', '_') + '.json')
+
+def readCache(PoolId):
+    # Returns (fetch time, missing patch count) or None
+    try:
+        with open(cachePath(PoolId)) as f:
+            Entry = json.load(f)
+        return float(Entry['time']), int(Entry['missing_patches'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
 
-
-def getData(ApiUri, ReqType, Custom404 = False):
+def writeCache(PoolId, MissingPatches):
     try:
-        if ReqType == "get":
-                req = requests.get(str(XoCompleteUrl) + ApiUri, cookies=Cookies, timeout=Timeout)
-        elif ReqType == "post":
-            req = requests.post(str(XoCompleteUrl) + ApiUri, cookies=Cookies, timeout=Timeout)
-        else:
-            print('Error: Unknown Request Type!')
-            exit(3)
-
-        req.raise_for_status()
-        return req.text
-    except requests.HTTPError as ex:
-        if req.status_code == 404 and Custom404 == True:
-            return '{ "name_label": "NOT_FOUND" }'
-        else:
-            print('Error while getting Data: ' + str(ex))
-            exit(3)
-    except requests.Timeout:
-            print('Error while getting Data: Timeout')
-            exit(3)
+        with tempfile.NamedTemporaryFile('w', dir=CacheDir, delete=False) as f:
+            json.dump({'time': time.time(), 'missing_patches': MissingPatches}, f)
+        os.replace(f.name, cachePath(PoolId))
+    except OSError:
+        pass
+
+def refreshPool(RefreshClient, PoolId):
+    # The lock keeps overlapping check runs from refreshing the same pool twice
+    with open(cachePath(PoolId) + '.lock', 'w') as Lock:
+        try:
+            fcntl.flock(Lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        Cached = readCache(PoolId)
+        if Cached is not None and time.time() - Cached[0] < CacheTtl:
+            return
+        try:
+            writeCache(PoolId, len(RefreshClient.get('/pools/' + PoolId + '/missing_patches')))
+        except XoError:
+            pass
+
+def refreshPools(PoolIds, Workers, Retries):
+    RefreshClient = XoClient(XoServerProto, XoServerUrl, XoAuthToken, Timeout=Timeout, Retries=Retries, PoolSize=Workers)
+    with ThreadPoolExecutor(max_workers=Workers) as Refresher:
+        for PoolId in PoolIds:
+            Refresher.submit(refreshPool, RefreshClient, PoolId)
+
+def refreshInBackground(PoolIds, Workers, Retries):
+    # Stale answers have already been reported, refresh them in a detached process so the check returns now.
+    # A new interpreter instead of fork(), request threads may still hold locks the child would inherit
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                      '--protocol', str(XoServerProto), '--url', str(XoServerUrl),
+                      '--retries', str(Retries), '--workers', str(Workers),
+                      '--cache-ttl', str(CacheTtl), '--cache-dir', CacheDir, '--refresh-pools', ','.join(PoolIds)],
+                     env=dict(os.environ, **{TokenEnv: str(XoAuthToken)}),
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     close_fds=True, start_new_session=True)
+
+def perfLabel(Name):
+    return "'" + Name.replace("'", '') + "'"
+
 
 def debugPrint(Text):
     if Debug == True:
@@ -50,6 +111,19 @@ def parse_opts():
     parser.add_option("--protocol")
     parser.add_option("--url")
     parser.add_option("--token")
+    parser.add_option("--retries", type="int", default=2, help="retries for timeouts and 5xx answers (default 2)")
+    parser.add_option("--workers", type="int", default=8, help="pools fetched at the same time (default 8)")
+    parser.add_option("--deadline", type="float", default=50, help="seconds after which unfinished pools are UNKNOWN (default 50)")
+    parser.add_option("--cache-ttl", dest="cache_ttl", type="int", default=0,
+                      help="reuse missing_patches answers for this many seconds, older ones are refreshed in the background (default 0, off)")
+    parser.add_option("--cache-max-stale", dest="cache_max_stale", type="int", default=7 * 86400,
+                      help="answers older than this many seconds are fetched before reporting (default 604800)")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="directory for cached answers (default <tmpdir>/check_xoa_pools_patches-<url>)")
+    parser.add_option("--snapshot", help="read pools and missing patches from this xoa_events.py snapshot instead of the REST API")
+    parser.add_option("--snapshot-max-age", dest="snapshot_max_age", type="float", default=120,
+                      help="snapshots older than this many seconds are UNKNOWN (default 120)")
+    parser.add_option("--refresh-pools", dest="refresh_pools", help=optparse.SUPPRESS_HELP)
     return parser.parse_args()
 
 
@@ -58,38 +132,109 @@ if __name__ == '__main__':
 
     XoServerProto   = options.protocol
     XoServerUrl     = options.url
-    XoAuthToken     = options.token
-
-    XoCompleteUrl     = str(XoServerProto) + '://' + str(XoServerUrl) + str(XoApiUri)
-    Cookies = { 'authenticationToken': str(XoAuthToken) }
-
-    XoPools = getData('/pools' ,'get')
-
-    jsn_list = json.loads(XoPools)
-    for pool in jsn_list:
-        #debugPrint(str(pool))
-        pool_uuid = str(pool).replace('/rest/v0','')
-        XoPoolsDetails = getData(pool_uuid ,'get')
-        XoPoolsDetailsJsonList = json.loads(XoPoolsDetails)
-        #debugPrint(str(XoPoolsDetailsJsonList))
-        XoPoolName = str(XoPoolsDetailsJsonList['name_label'])
-
-        XoPoolsDetailsMissingPatches = getData(pool_uuid + '/missing_patches','get')
-        #debugPrint(str(XoPoolsDetailsMissingPatches))
-        XoPoolsDetailsMissingPatchesJsonList = json.loads(XoPoolsDetailsMissingPatches)
-        if not XoPoolsDetailsMissingPatchesJsonList:
+    XoAuthToken     = options.token or os.environ.pop(TokenEnv, None)
+    CacheTtl        = options.cache_ttl
+    CacheMaxStale   = max(options.cache_max_stale, CacheTtl)
+    CacheDir        = options.cache_dir or os.path.join(tempfile.gettempdir(), 'check_xoa_pools_patches-' + str(XoServerUrl).replace('/', '_'))
+    if CacheTtl > 0:
+        os.makedirs(CacheDir, mode=0o700, exist_ok=True)
+
+    if options.refresh_pools:
+        # Started by refreshInBackground() of an earlier run
+        refreshPools(options.refresh_pools.split(','), options.workers, options.retries)
+        exit(0)
+
+    Deadline = time.monotonic() + options.deadline
+    Client = XoClient(XoServerProto, XoServerUrl, XoAuthToken, Timeout=Timeout, Retries=options.retries, PoolSize=options.workers)
+
+    try:
+        if options.snapshot:
+            XoSnapshot = readSnapshot(options.snapshot, options.snapshot_max_age)
+            XoPools = list(XoSnapshot['objects'].get('pool', {}).values())
+        else:
+            XoPools = Client.get('/pools', Fields=['id', 'name_label'], Timeout=min(Timeout, options.deadline))
+    except XoError as ex:
+        print('Error while getting Data: ' + str(ex))
+        exit(3)
+
+    # Answers from the cache, stale ones are used as well but refreshed afterwards
+    XoCached = {}
+    XoStalePools = []
+    if options.snapshot:
+        # The daemon lists missing patches itself, pools it has not got to yet are UNKNOWN
+        XoMissingPatches = XoSnapshot.get('missing_patches', {})
+        for pool in XoPools:
+            if str(pool['id']) in XoMissingPatches:
+                Entry = XoMissingPatches[str(pool['id'])]
+                XoCached[str(pool['id'])] = (int(Entry['count']), max(0, time.time() - float(Entry['time'])))
+            else:
+                XoUnknownPools.append(str(pool['name_label']) + ': no patch data in snapshot yet')
+    elif CacheTtl > 0:
+        for pool in XoPools:
+            Cached = readCache(str(pool['id']))
+            if Cached is None:
+                continue
+            Age = max(0, time.time() - Cached[0])
+            if Age >= CacheMaxStale:
+                continue
+            XoCached[str(pool['id'])] = (Cached[1], Age)
+            if Age >= CacheTtl:
+                XoStalePools.append(str(pool['id']))
+
+    Executor = ThreadPoolExecutor(max_workers=options.workers)
+    XoFetchPools = [] if options.snapshot else [pool for pool in XoPools if str(pool['id']) not in XoCached]
+    Futures = {Executor.submit(getMissingPatches, str(pool['id'])): str(pool['name_label']) for pool in XoFetchPools}
+    Done, NotDone = wait(Futures, timeout=max(0, Deadline - time.monotonic()))
+    Executor.shutdown(wait=False, cancel_futures=True)
+
+    XoResults = [(str(pool['name_label']), pool['id'], None) for pool in XoPools if str(pool['id']) in XoCached]
+    XoResults += [(XoPoolName, None, Future) for Future, XoPoolName in Futures.items()]
+    XoMaxAge = None
+    for XoPoolName, PoolId, Future in sorted(XoResults, key=lambda item: item[0]):
+        if Future is None:
+            MissingPatches, Age = XoCached[str(PoolId)]
+            Duration = None
+            XoMaxAge = Age if XoMaxAge is None else max(XoMaxAge, Age)
+        elif Future not in Done:
+            debugPrint(XoPoolName + ': deadline reached')
+            XoUnknownPools.append(XoPoolName + ': deadline reached')
+            continue
+        else:
+            try:
+                MissingPatches, Duration = Future.result()
+            except XoError as ex:
+                debugPrint(XoPoolName + ': ' + str(ex))
+                XoUnknownPools.append(XoPoolName + ': ' + str(ex))
+                continue
+            Age = 0
+        XoPerfData.append(perfLabel(XoPoolName + ' missing_patches') + '=' + str(MissingPatches) + ';;0;0')
+        if Duration is not None:
+            XoPerfData.append(perfLabel(XoPoolName + ' duration') + '=' + '{:.3f}'.format(Duration) + 's')
+        if CacheTtl > 0 or options.snapshot:
+            XoPerfData.append(perfLabel(XoPoolName + ' age') + '=' + '{:.0f}'.format(Age) + 's')
+        if MissingPatches == 0:
             debugPrint(XoPoolName + ': ok')
         else:
             debugPrint(XoPoolName + ': critical')
-            XoCritPools.append(XoPoolName + ' count: ' + str(len(XoPoolsDetailsMissingPatchesJsonList)))
+            XoCritPools.append(XoPoolName + ' count: ' + str(MissingPatches))
+
+    XoPerfText = (' | ' + ' '.join(XoPerfData)) if XoPerfData else ''
+    if XoMaxAge is not None:
+        XoPerfText = ' (cached data up to ' + '{:.0f}'.format(XoMaxAge) + 's old)' + XoPerfText
+    if XoStalePools:
+        refreshInBackground(XoStalePools, options.workers, options.retries)
+    # Requests still running after the deadline must not hold up the exit
+    Exit = os._exit if NotDone else exit
 
     if len(XoCritPools) > 0:
         XoOutputText = str(XoCritPools)
-        print('CRITICAL - ' + XoOutputText)
-        exit(2)
-    else:
-        print('OK - Super Arbeit Jungs (& Mädels)!')
-        exit(0)
-
-    print("Hier sollte man niemals landen... Glückwunsch zu der Leistung...")
-    exit(3)
\ No newline at end of file
+        if len(XoUnknownPools) > 0:
+            XoOutputText = XoOutputText + ", UNKNOWN: " + str(XoUnknownPools)
+        print('CRITICAL - ' + XoOutputText + XoPerfText, flush=True)
+        Exit(2)
+    if len(XoUnknownPools) > 0:
+        XoOutputText = str(XoUnknownPools)
+        print('UNKNOWN - ' + XoOutputText + XoPerfText, flush=True)
+        Exit(3)
+    print('OK - Super Arbeit Jungs (& Mädels)!' + XoPerfText, flush=True)
+    Exit(0)
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
-import requests
+import fcntl
 import json
+import os
+import struct
+import tempfile
+import time
 from optparse import OptionParser
+from xoa_client import XoClient, XoError, iterJsonArray, readSnapshot
 #    User Vars
-XoApiUri     = '/rest/v0'
 ExcludeTag = 'no_monitoring'
 Debug = False
 
@@ -20,54 +24,271 @@ XoWarnSRs    = []
 XoCritSRs    = []
 XoOutputText    = ''
 
+XoWarnCount     = 0
+XoCritCount     = 0
+MaxOutput       = 8192
+
 Timeout = 10
 
+XoContainerNames = None
+NameCacheTtl    = 0
+NameCacheFile   = ''
 
-def getData(ApiUri, ReqType, Custom404 = False):
-    try:
-        if ReqType == "get":
-                req = requests.get(str(XoCompleteUrl) + ApiUri, cookies=Cookies, timeout=Timeout)
-        elif ReqType == "post":
-            req = requests.post(str(XoCompleteUrl) + ApiUri, cookies=Cookies, timeout=Timeout)
-        else:
-            print('Error: Unknown Request Type!')
-            exit(3)
-
-        req.raise_for_status()
-        return req.text
-    except requests.HTTPError as ex:
-        if req.status_code == 404 and Custom404 == True:
-            return '{ "name_label": "NOT_FOUND" }'
+XoPerfData      = []
+XoPerfLength    = 0
+XoPerfCut       = 0
+HistoryDir      = ''
+HistoryInterval = 240
+HistorySize     = 2016
+EtaWarn         = None
+EtaCrit         = None
+
+
+class SrHistory:
+    # Usage samples of one SR in a fixed size ring, with the sums of a linear
+    # regression kept in the header so a run only touches the header, the new
+    # and the overwritten record instead of the whole history.
+    #
+    # header: magic, capacity, next slot, count, time base, sum t, sum u, sum t*t, sum t*u
+    #         (t relative to the time base, u in bytes)
+    # record: time, used bytes
+    MAGIC = b'XSH1'
+    HEADER = struct.Struct('<4sIIIddddd')
+    RECORD = struct.Struct('<dd')
+
+    def __init__(self, Path, Capacity = 2016):
+        self.path = Path
+        self.capacity = Capacity
+        self.fd = os.open(Path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            Header = self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))
+        except struct.error:
+            Header = None
+        if Header is None or Header[0] != self.MAGIC or Header[1] != Capacity:
+            Header = (self.MAGIC, Capacity, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        (Magic, Capacity, self.next, self.count, self.base,
+         self.sum_t, self.sum_u, self.sum_tt, self.sum_tu) = Header
+
+    def record(self, Slot):
+        return self.RECORD.unpack(os.pread(self.fd, self.RECORD.size, self.HEADER.size + Slot * self.RECORD.size))
+
+    def last(self):
+        return self.record((self.next - 1) % self.capacity) if self.count else None
+
+    def add(self, Time, Used):
+        if self.count == 0:
+            self.base = Time
+        if self.count == self.capacity:
+            OldTime, OldUsed = self.record(self.next)
+            self.accumulate(OldTime, OldUsed, -1)
         else:
-            print('Error while getting Data: ' + str(ex))
-            exit(3)
-    except requests.Timeout:
-            print('Error while getting Data: Timeout')
-            exit(3)
+            self.count += 1
+        os.pwrite(self.fd, self.RECORD.pack(Time, Used), self.HEADER.size + self.next * self.RECORD.size)
+        self.accumulate(Time, Used, 1)
+        self.next = (self.next + 1) % self.capacity
+        if self.next == 0:
+            self.rebase()
+        os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.capacity, self.next, self.count, self.base,
+                                            self.sum_t, self.sum_u, self.sum_tt, self.sum_tu), 0)
+
+    def accumulate(self, Time, Used, Sign):
+        t = Time - self.base
+        self.sum_t += Sign * t
+        self.sum_u += Sign * Used
+        self.sum_tt += Sign * t * t
+        self.sum_tu += Sign * t * Used
+
+    def rebase(self):
+        # Once per round through the ring: move the time base to the oldest sample
+        # and sum up again, so rounding errors of the running sums cannot pile up
+        Records = [self.record(Slot) for Slot in range(self.count)]
+        self.base = min(Time for Time, Used in Records)
+        self.sum_t = self.sum_u = self.sum_tt = self.sum_tu = 0.0
+        for Time, Used in Records:
+            self.accumulate(Time, Used, 1)
+
+    def growth(self, MinSamples = 6, MinSpan = 3600):
+        # Least squares slope in bytes per second, None while there is too little history
+        n = self.count
+        if n < MinSamples:
+            return None
+        Denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        if Denominator <= 0 or Denominator < (n * MinSpan) ** 2 / 12:
+            return None
+        return (n * self.sum_tu - self.sum_t * self.sum_u) / Denominator
+
+    def close(self):
+        os.close(self.fd)
+
+
+def getContainerNames():
+    # Names of all pools and hosts, fetched with one request each instead of one per SR
+    global XoContainerNames
+    if XoContainerNames is not None:
+        return XoContainerNames
+
+    if NameCacheTtl > 0:
+        try:
+            if time.time() - os.path.getmtime(NameCacheFile) < NameCacheTtl:
+                with open(NameCacheFile) as f:
+                    XoContainerNames = json.load(f)
+                return XoContainerNames
+        except (OSError, ValueError):
+            pass
+
+    XoContainerNames = {}
+    for ContainerType in ('pools', 'hosts'):
+        XoContainerNames[ContainerType] = {
+            str(container['id']): str(container['name_label'])
+            for container in Client.get('/' + ContainerType, Fields=['id', 'name_label'])
+        }
+
+    if NameCacheTtl > 0:
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(NameCacheFile), delete=False) as f:
+                json.dump(XoContainerNames, f)
+            os.replace(f.name, NameCacheFile)
+        except OSError:
+            pass
+    return XoContainerNames
 
 def getHostnameOfSR(ContainerId, ContentType, SrType):
     if ContentType == 'iso' and SrType == 'iso':
-        XoContainerData = getData('/pools/' + str(ContainerId), 'get', True)
+        ContainerType = 'pools'
     elif ContentType == 'user' and SrType == 'lvmoiscsi':
-        XoContainerData = getData('/pools/' + str(ContainerId), 'get', True)
+        ContainerType = 'pools'
     elif ContentType == '' and SrType == 'nfs':
-        XoContainerData = getData('/pools/' + str(ContainerId), 'get', True)
+        ContainerType = 'pools'
     elif ContentType == 'user' and SrType == 'nfs':
-        XoContainerData = getData('/pools/' + str(ContainerId), 'get', True)
+        ContainerType = 'pools'
     elif ContentType == 'disk' and SrType == 'udev':
-        XoContainerData = getData('/hosts/' + str(ContainerId), 'get', True)
+        ContainerType = 'hosts'
     elif ContentType == 'iso' and SrType == 'udev':
-        XoContainerData = getData('/hosts/' + str(ContainerId), 'get', True)
+        ContainerType = 'hosts'
     elif ContentType == 'user' and SrType == 'lvm':
-        XoContainerData = getData('/hosts/' + str(ContainerId), 'get', True)
+        ContainerType = 'hosts'
     elif ContentType == 'user' and SrType == 'ext':
-        XoContainerData = getData('/hosts/' + str(ContainerId), 'get', True)
+        ContainerType = 'hosts'
     else:
         return 'COMBO_NOT_FOUND'
 
-    XoContainerDataJson = json.loads(XoContainerData)
+    return getContainerNames()[ContainerType].get(ContainerId, 'NOT_FOUND')
 
-    return XoContainerDataJson['name_label']
+
+def checkSR(lis, Labelled = True):
+    # Returns status, usage in percent, perfdata and the output line for non-OK SRs,
+    # the perfdata labels carry the SR name unless the result is for the SR alone
+    SrPerfData = []
+    percent = 0
+    if lis['size'] > 0:
+        percent = round((lis['physical_usage']/lis['size'])*100, 3)
+
+    # Growth from the stored history, ETA in days until the SR is full
+    Growth = None
+    Eta = None
+    if HistoryDir and lis['size'] > 0:
+        History = SrHistory(os.path.join(HistoryDir, str(lis['id']).replace('/', '_') + '.hist'), HistorySize)
+        try:
+            Now = time.time()
+            Last = History.last()
+            if Last is None or Now - Last[0] >= HistoryInterval:
+                History.add(Now, float(lis['physical_usage']))
+            Growth = History.growth()
+        finally:
+            History.close()
+        if Growth is not None and Growth > 0:
+            Eta = max(0, lis['size'] - lis['physical_usage']) / Growth / 86400
+    EtaText = (', full in ' + '{:.1f}'.format(Eta) + 'd') if Eta is not None else ''
+
+    XoPerfLabel = "'" + (str(lis['name_label']).replace("'", '') + ' (' + str(lis['id'])[:8] + ') ' if Labelled else '')
+    SrPerfData.append(XoPerfLabel + "usage'=" + str(percent) + '%;' + str(TresholdWarn) + ';' + str(TresholdCrit) + ';0;100')
+    if Growth is not None:
+        SrPerfData.append(XoPerfLabel + "growth_per_day'=" + '{:.0f}'.format(Growth * 86400) + 'B')
+    if Eta is not None:
+        SrPerfData.append(XoPerfLabel + "eta_days'=" + '{:.2f}'.format(Eta) + ';' + str(EtaWarn or '') + ';' + str(EtaCrit or ''))
+
+    if percent > int(TresholdCrit) or (Eta is not None and EtaCrit is not None and Eta < EtaCrit):
+        status = 'Critical'
+        SrText = ('SR-ID: ' + str(lis['id']) + ', ' + str(percent)  + '%, Name: ' + str(lis['name_label']) + ', Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')' + EtaText)
+    elif percent > int(TresholdWarn) or (Eta is not None and EtaWarn is not None and Eta < EtaWarn):
+        status = 'Warning'
+        SrText = ('SR-ID: ' + str(lis['id']) + ', ' + str(percent)  + '%, Name: ' + str(lis['name_label']) + ', Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')' + EtaText)
+    else:
+        status = 'OK'
+        SrText = None
+    return status, percent, SrPerfData, SrText
+
+
+def keepRow(Rows, Text):
+    # Keeps output lines only as long as they fit into the output, the rest are counted
+    if MaxOutput <= 0 or sum(len(Row) + 4 for Row in Rows) + len(Text) <= MaxOutput:
+        Rows.append(Text)
+
+def keepPerfData(SrPerfData):
+    # Same budget as the SR lines, once an SR does not fit its perfdata and that of all further SRs is only counted
+    global XoPerfLength, XoPerfCut
+    Length = sum(len(Item) + 1 for Item in SrPerfData)
+    if MaxOutput <= 0 or (XoPerfCut == 0 and XoPerfLength + Length <= MaxOutput):
+        XoPerfData.extend(SrPerfData)
+        XoPerfLength += Length
+    else:
+        XoPerfCut += 1
+
+def formatRows(Rows, Count):
+    if len(Rows) < Count:
+        return str(Rows + ['... ' + str(Count - len(Rows)) + ' more'])
+    return str(Rows)
+
+def evaluateSRs(Srs, PerfData = 'all'):
+    # Consumes the SRs one by one and keeps nothing but the rows of problem SRs
+    global XoWarnCount, XoCritCount
+    for lis in Srs:
+        status, percent, SrPerfData, SrText = checkSR(lis)
+        if PerfData == 'all' or (PerfData == 'problems' and status != 'OK'):
+            keepPerfData(SrPerfData)
+        if status == 'Critical':
+            XoCritCount += 1
+            keepRow(XoCritSRs, SrText)
+        elif status == 'Warning':
+            XoWarnCount += 1
+            keepRow(XoWarnSRs, SrText)
+        if Debug == True:
+            debugPrint('ID: ' + str(lis['id']) + ' | Status: ' + status + ' | Size: ' + str(lis['physical_usage']) + '/' + str(lis['size']) + ' | Percent: ' + str(percent)  + '% | Name: ' + str(lis['name_label']) + ' | Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')')
+
+def benchmark(Count):
+    # Synthetic /srs answer with Count SRs, parsed as one document and as a stream
+    import gc
+    import random
+    import tracemalloc
+    global XoContainerNames, XoPerfData, XoPerfLength, XoPerfCut
+    XoContainerNames = {'pools': {'pool-' + str(i): 'Pool ' + str(i) for i in range(50)}, 'hosts': {}}
+    Types = [('user', 'nfs'), ('iso', 'iso'), ('disk', 'udev'), ('user', 'lvmoiscsi')]
+    Payload = json.dumps([{
+        'name_label': 'SR ' + str(i), '$container': 'pool-' + str(i % 50), 'size': 10**12 if i % 3 else 0,
+        'usage': 0, 'id': '%08x-0000-0000-0000-%012x' % (i, i), 'physical_usage': random.randint(0, 10**12),
+        'content_type': Types[i % 4][0], 'SR_type': Types[i % 4][1],
+    } for i in range(Count)]).encode()
+    Chunks = [Payload[i:i + 65536] for i in range(0, len(Payload), 65536)]
+    print('payload: ' + str(Count) + ' SRs, ' + str(len(Payload) // 1024) + ' KiB')
+    for Name, Parse in (('json.loads', lambda: json.loads(b''.join(Chunks))),
+                        ('stream', lambda: iterJsonArray(Chunk.decode() for Chunk in Chunks))):
+        for PerfData in ('all', 'problems'):
+            del XoCritSRs[:], XoWarnSRs[:]
+            XoPerfData, XoPerfLength, XoPerfCut = [], 0, 0
+            gc.collect()
+            Start = time.perf_counter()
+            evaluateSRs(Parse(), PerfData)
+            Duration = time.perf_counter() - Start
+            # Memory in a second run, tracing slows the first one down too much
+            del XoCritSRs[:], XoWarnSRs[:]
+            XoPerfData, XoPerfLength, XoPerfCut = [], 0, 0
+            gc.collect()
+            tracemalloc.start()
+            evaluateSRs(Parse(), PerfData)
+            Peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:<10} perfdata={:<8} {:7.1f} ms  peak {:7.1f} MiB'.format(Name, PerfData, Duration * 1000, Peak / 2**20))
 
 
 def debugPrint(Text):
@@ -81,52 +302,89 @@ def parse_opts():
     parser.add_option("--token")
     parser.add_option("--warning")
     parser.add_option("--critical")
+    parser.add_option("--retries", type="int", default=2, help="retries for timeouts and 5xx answers (default 2)")
+    parser.add_option("--name-cache-ttl", dest="name_cache_ttl", type="int", default=0,
+                      help="keep pool and host names on disk for this many seconds (default 0, off)")
+    parser.add_option("--name-cache-file", dest="name_cache_file",
+                      help="file for the name cache (default <tmpdir>/check_xoa_srs-<url>.names)")
+    parser.add_option("--history-dir", dest="history_dir",
+                      help="keep the usage history of every SR here and forecast when it is full")
+    parser.add_option("--history-interval", dest="history_interval", type="float", default=240,
+                      help="minimum seconds between two stored samples (default 240)")
+    parser.add_option("--history-size", dest="history_size", type="int", default=2016,
+                      help="samples kept per SR (default 2016, a week at 5 minutes)")
+    parser.add_option("--warning-eta", dest="warning_eta", type="float", help="WARNING if an SR is projected to be full within this many days")
+    parser.add_option("--critical-eta", dest="critical_eta", type="float", help="CRITICAL if an SR is projected to be full within this many days")
+    parser.add_option("--max-output", dest="max_output", type="int", default=8192,
+                      help="characters of SR lines and of perfdata in the output, the rest is only counted (default 8192, 0 for no limit)")
+    parser.add_option("--perfdata", type="choice", choices=("all", "problems", "none"), default="all",
+                      help="perfdata for all SRs, only WARNING/CRITICAL ones or none (default all)")
+    parser.add_option("--benchmark", type="int", metavar="COUNT", help="time the SR processing with a synthetic answer of COUNT SRs")
+    parser.add_option("--snapshot", help="read SRs, pools and hosts from this xoa_events.py snapshot instead of the REST API")
+    parser.add_option("--snapshot-max-age", dest="snapshot_max_age", type="float", default=120,
+                      help="snapshots older than this many seconds are UNKNOWN (default 120)")
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     (options, args) = parse_opts()
 
+    if options.benchmark:
+        TresholdWarn, TresholdCrit = options.warning or 80, options.critical or 90
+        benchmark(options.benchmark)
+        exit(0)
+
     XoServerProto   = options.protocol
     XoServerUrl     = options.url
     XoAuthToken     = options.token
     TresholdWarn    = options.warning
     TresholdCrit    = options.critical
+    NameCacheTtl    = options.name_cache_ttl
+    MaxOutput       = options.max_output
+    HistoryDir      = options.history_dir
+    HistoryInterval = options.history_interval
+    HistorySize     = options.history_size
+    EtaWarn         = options.warning_eta
+    EtaCrit         = options.critical_eta
+    if HistoryDir:
+        os.makedirs(HistoryDir, mode=0o700, exist_ok=True)
+    NameCacheFile   = options.name_cache_file or os.path.join(tempfile.gettempdir(), 'check_xoa_srs-' + str(XoServerUrl).replace('/', '_') + '.names')
 
-    XoCompleteUrl     = str(XoServerProto) + '://' + str(XoServerUrl) + str(XoApiUri)
-    Cookies = { 'authenticationToken': str(XoAuthToken) }
+    Client = XoClient(XoServerProto, XoServerUrl, XoAuthToken, Timeout=Timeout, Retries=options.retries)
 
-    XoSrs = getData('/srs?fields=name_label,$container,size,usage,id,physical_usage,content_type,SR_type&filter=!"tags":"' + ExcludeTag + '"', 'get')
-
-    jsn_list = json.loads(XoSrs)
-
-    for lis in jsn_list:
-        percent = 0
-        if lis['size'] > 0:
-            percent = round((lis['physical_usage']/lis['size'])*100, 3)
-        if percent > int(TresholdWarn) and percent < int(TresholdCrit):
-            status = 'Warning'
-            XoWarnSRs.append('SR-ID: ' + str(lis['id']) + ' | ' + str(percent)  + '% | Name: ' + str(lis['name_label']) + ' | Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')')
-        elif percent > int(TresholdCrit):
-            status = 'Critical'
-            XoCritSRs.append('SR-ID: ' + str(lis['id']) + ' | ' + str(percent)  + '% | Name: ' + str(lis['name_label']) + ' | Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')')
+    try:
+        if options.snapshot:
+            XoSnapshot = readSnapshot(options.snapshot, options.snapshot_max_age)
+            XoContainerNames = {
+                ContainerType: {str(container['id']): str(container['name_label']) for container in XoSnapshot['objects'].get(ObjectType, {}).values()}
+                for ContainerType, ObjectType in (('pools', 'pool'), ('hosts', 'host'))
+            }
+            jsn_list = (sr for sr in XoSnapshot['objects'].get('SR', {}).values() if ExcludeTag not in sr.get('tags', []))
         else:
-            status = 'OK'
-        debugPrint('ID: ' + str(lis['id']) + ' | Status: ' + status + ' | Size: ' + str(lis['physical_usage']) + '/' + str(lis['size']) + ' | Percent: ' + str(percent)  + '% | Name: ' + str(lis['name_label']) + ' | Container: ' + str(getHostnameOfSR(str(lis['$container']), str(lis['content_type']), str(lis['SR_type']))) + ' ('+ str(lis['$container']) + ')')
+            jsn_list = Client.iterate('/srs', Fields=['name_label', '$container', 'size', 'usage', 'id', 'physical_usage', 'content_type', 'SR_type'],
+                                      Filter='!"tags":"' + ExcludeTag + '"')
+        evaluateSRs(jsn_list, options.perfdata)
+    except XoError as ex:
+        print('Error while getting Data: ' + str(ex))
+        exit(3)
+
 
+    XoPerfText = (' | ' + ' '.join(XoPerfData)) if XoPerfData else ''
+    if XoPerfCut > 0:
+        XoPerfText = ' ... perfdata of ' + str(XoPerfCut) + ' more SRs cut' + XoPerfText
 
-    if len(XoCritSRs) > 0:
-        XoOutputText = str(XoCritSRs)
-        if len(XoWarnSRs) > 0:
-            XoOutputText = XoOutputText + ", WARNING: " + str(XoWarnSRs)
-        print('CRITICAL - ' + XoOutputText)
+    if XoCritCount > 0:
+        XoOutputText = formatRows(XoCritSRs, XoCritCount)
+        if XoWarnCount > 0:
+            XoOutputText = XoOutputText + ", WARNING: " + formatRows(XoWarnSRs, XoWarnCount)
+        print('CRITICAL - ' + XoOutputText + XoPerfText)
         exit(2)
-    if len(XoWarnSRs) > 0:
-        XoOutputText = str(XoWarnSRs)
-        print('WARNING - ' + str(XoOutputText))
+    if XoWarnCount > 0:
+        XoOutputText = formatRows(XoWarnSRs, XoWarnCount)
+        print('WARNING - ' + str(XoOutputText) + XoPerfText)
         exit(1)
-    if len(XoWarnSRs) == 0 and len(XoCritSRs) == 0:
-        print('OK - Super Arbeit Jungs (& Mädels)!')
+    if XoWarnCount == 0 and XoCritCount == 0:
+        print('OK - Super Arbeit Jungs (& Mädels)!' + XoPerfText)
         exit(0)
 
     print("Hier sollte man niemals landen... Glückwunsch zu der Leistung...")
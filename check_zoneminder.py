@@ -4,51 +4,237 @@
 import requests
 import sys
 import argparse
+import fcntl
+import hashlib
+import json
+import os
 import re
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote
 
 BYTES_IN_MB = 1024 * 1024
+BYTES_IN_GB = 1024 * BYTES_IN_MB
+# Tokens are renewed this many seconds before they expire
+TOKEN_MARGIN = 60
 
+# Login and all API calls of a run share the keep-alive connections of one session,
+# the main block sizes its pool for the requests running at the same time
+session = requests.Session()
 
-def get_token(base_url, username, password):
+
+class LoginError(Exception):
+    """Logging in failed, may happen in a worker thread, the main block reports it once."""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def login(base_url, username, password):
     try:
-        resp = requests.post(
+        resp = session.post(
             f"{base_url}/host/login.json",
             data={"user": username, "pass": password},
             timeout=5
         )
         resp.raise_for_status()
         data = resp.json()
-        token = data.get("access_token")
-        if not token:
-            print("CRITICAL - No access_token returned")
-            sys.exit(2)
-        return token
     except Exception as e:
-        print(f"UNKNOWN - Login error: {e}")
-        sys.exit(3)
+        raise LoginError(f"UNKNOWN - Login error: {e}", 3)
+    if not data.get("access_token"):
+        raise LoginError("CRITICAL - No access_token returned", 2)
+    return data
 
 
-def check_daemon(base_url, token):
+def refresh(base_url, refresh_token):
+    """Get a new access token with the refresh token, None if ZoneMinder refuses it."""
     try:
-        url = f"{base_url}/host/daemonCheck.json?token={token}"
-        resp = requests.get(url, timeout=5)
+        resp = session.post(f"{base_url}/host/login.json", data={"token": refresh_token}, timeout=5)
         resp.raise_for_status()
-        if str(resp.json().get("result")) != "1":
-            print("CRITICAL - ZoneMinder daemon is NOT running")
+        data = resp.json()
+    except Exception:
+        return None
+    return data if data.get("access_token") else None
+
+
+def get_token(base_url, username, password, cache_file=None, refused=None):
+    """refused is a token ZoneMinder did not accept, it is replaced even if it has not expired yet."""
+    if cache_file is None:
+        return login(base_url, username, password)["access_token"]
+
+    # One entry per API and user, a changed password does not reuse old tokens
+    key = hashlib.sha256(f"{base_url}\0{username}\0{password}".encode()).hexdigest()
+    # Checks starting at the same time wait here for the first one instead of all logging in
+    with open(cache_file + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        entry = cache.get(key) if isinstance(cache, dict) else None
+        now = time.time()
+        if entry and entry.get("access_expires", 0) - TOKEN_MARGIN > now and entry["access_token"] != refused:
+            return entry["access_token"]
+
+        data = None
+        if entry and entry.get("refresh_token") and entry.get("refresh_expires", 0) - TOKEN_MARGIN > now:
+            data = refresh(base_url, entry["refresh_token"])
+        if data is None:
+            data = login(base_url, username, password)
+            entry = {}
+
+        entry["access_token"] = data["access_token"]
+        entry["access_expires"] = now + float(data.get("access_token_expires", 3600))
+        if data.get("refresh_token"):
+            entry["refresh_token"] = data["refresh_token"]
+            entry["refresh_expires"] = now + float(data.get("refresh_token_expires", 86400))
+        # Drop entries nobody has renewed
+        cache = {k: v for k, v in (cache if isinstance(cache, dict) else {}).items()
+                 if max(v.get("access_expires", 0), v.get("refresh_expires", 0)) > now}
+        cache[key] = entry
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(cache_file)), delete=False) as f:
+                os.fchmod(f.fileno(), 0o600)
+                json.dump(cache, f)
+            os.replace(f.name, cache_file)
+        except OSError:
+            pass
+        return entry["access_token"]
+
+
+# Called with a token ZoneMinder refused and returns a new one, set up by the main block
+token_source = None
+renewed_tokens = {}
+
+
+def api_get(base_url, path, token, params=None):
+    """
+    GET an API path, returns the decoded answer and the seconds the call took.
+
+    A token ZoneMinder refuses before it expires (changed AUTH_HASH_SECRET or
+    user, logged out) is renewed through token_source and the call retried once.
+    """
+    start = time.monotonic()
+    token = renewed_tokens.get(token, token)
+    resp = session.get(f"{base_url}{path}", params=dict(params or {}, token=token), timeout=5)
+    if resp.status_code == 401 and token_source is not None:
+        renewed_tokens[token] = token_source(token)
+        resp = session.get(f"{base_url}{path}", params=dict(params or {}, token=renewed_tokens[token]), timeout=5)
+    resp.raise_for_status()
+    return resp.json(), time.monotonic() - start
+
+
+def check_daemon(base_url, token, prefetched=None):
+    """prefetched is a future of api_get() started by the caller, e.g. alongside the camera check."""
+    try:
+        data, elapsed = prefetched.result() if prefetched else api_get(base_url, "/host/daemonCheck.json", token)
+        perfdata = f"daemon_time={elapsed:.3f}s"
+        if str(data.get("result")) != "1":
+            print(f"CRITICAL - ZoneMinder daemon is NOT running | {perfdata}")
             return 2
-        print("OK - ZoneMinder daemon is running")
+        print(f"OK - ZoneMinder daemon is running | {perfdata}")
         return 0
+    except LoginError:
+        raise
     except Exception as e:
         print(f"UNKNOWN - API call to daemonCheck failed: {e}")
         return 3
 
 
-def check_cameras(base_url, token):
+def get_monitors(base_url, token, cache_file=None, ttl=0):
+    """
+    Return monitors.json and the seconds it took to get it, shared between
+    checks through cache_file for ttl seconds.
+
+    Only the first check after the snapshot expired fetches a new one, the
+    others wait on the lock and then read what it wrote.
+    """
+    start = time.monotonic()
+    if cache_file is None or ttl <= 0:
+        return api_get(base_url, "/monitors.json", token)
+
+    def read_fresh():
+        try:
+            with open(cache_file) as f:
+                snapshot = json.load(f)
+            if snapshot.get("base_url") == base_url and 0 <= time.time() - snapshot["time"] < ttl:
+                return snapshot["data"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+        return None
+
+    data = read_fresh()
+    if data is not None:
+        return data, time.monotonic() - start
+    with open(cache_file + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = read_fresh()
+        if data is not None:
+            return data, time.monotonic() - start
+        data, _ = api_get(base_url, "/monitors.json", token)
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(cache_file)), delete=False) as f:
+                os.fchmod(f.fileno(), 0o600)
+                json.dump({"time": time.time(), "base_url": base_url, "data": data}, f)
+            os.replace(f.name, cache_file)
+        except OSError:
+            pass
+        return data, time.monotonic() - start
+
+
+def describe_monitor(entry):
+    """Return name, id, enabled, healthy, status line and perfdata of one monitors.json entry."""
+    mon = entry.get("Monitor", {})
+    st = entry.get("Monitor_Status", {})
+    name = mon.get("Name", "Unknown")
+    fn = mon.get("Function", "")
+    en = str(mon.get("Enabled", "0"))
+    conn = st.get("Status", "Unknown")
+    fps = float(st.get("CaptureFPS", 0.0))
+    bw_mb = int(st.get("CaptureBandwidth", 0)) / BYTES_IN_MB
+
+    line = (f"{name} - Status: {conn}, Function: {fn}, Enabled: {en}, "
+            f"FPS: {fps:.2f}, BW: {bw_mb:.2f}MB/s")
+    key = re.sub(r"\W+", "_", name)
+    perf_items = [f"{key}_fps={fps:.2f}", f"{key}_bw={bw_mb:.2f}MB/s"]
+    healthy = conn == "Connected" and fn.lower() != "none"
+    return name, str(mon.get("Id", "")), en == "1", healthy, line, perf_items
+
+
+def check_monitor(base_url, token, monitor, cache_file=None, ttl=0):
     try:
-        url = f"{base_url}/monitors.json?token={token}"
-        resp = requests.get(url, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
+        data, elapsed = get_monitors(base_url, token, cache_file, ttl)
+        for entry in data.get("monitors", []):
+            name, mid, enabled, healthy, line, perf_items = describe_monitor(entry)
+            if monitor in (name, mid):
+                break
+        else:
+            print(f"UNKNOWN - Monitor {monitor} not found")
+            return 3
+
+        perfdata = " ".join(perf_items + [f"monitors_time={elapsed:.3f}s"])
+        if not enabled:
+            print(f"WARNING - Camera is disabled: {line} | {perfdata}")
+            return 1
+        if not healthy:
+            print(f"CRITICAL - Camera has issues: {line} | {perfdata}")
+            return 2
+        print(f"OK - Camera is healthy: {line} | {perfdata}")
+        return 0
+
+    except LoginError:
+        raise
+    except Exception as e:
+        print(f"UNKNOWN - Error checking camera: {e}")
+        return 3
+
+
+def check_cameras(base_url, token, cache_file=None, ttl=0, prefetched=None):
+    """prefetched is a future of get_monitors() started by the caller."""
+    try:
+        data, elapsed = prefetched.result() if prefetched else get_monitors(base_url, token, cache_file, ttl)
 
         bad = []
         good = []
@@ -57,23 +243,11 @@ def check_cameras(base_url, token):
         unhealthy = 0
 
         for entry in data.get("monitors", []):
-            mon = entry.get("Monitor", {})
-            st = entry.get("Monitor_Status", {})
-            name = mon.get("Name", "Unknown")
-            fn = mon.get("Function", "")
-            en = str(mon.get("Enabled", "0"))
-            conn = st.get("Status", "Unknown")
-            fps = float(st.get("CaptureFPS", 0.0))
-            bw_mb = int(st.get("CaptureBandwidth", 0)) / BYTES_IN_MB
-
-            line = (f"{name} - Status: {conn}, Function: {fn}, Enabled: {en}, "
-                    f"FPS: {fps:.2f}, BW: {bw_mb:.2f}MB/s")
-            key = re.sub(r"\W+", "_", name)
-            perf_items.append(f"{key}_fps={fps:.2f}")
-            perf_items.append(f"{key}_bw={bw_mb:.2f}MB/s")
+            name, mid, enabled, ok, line, items = describe_monitor(entry)
+            perf_items.extend(items)
 
-            if en == "1":
-                if conn != "Connected" or fn.lower() == "none":
+            if enabled:
+                if not ok:
                     bad.append(f"[BAD] {line}")
                     unhealthy += 1
                 else:
@@ -82,6 +256,7 @@ def check_cameras(base_url, token):
 
         perf_items.insert(0, f"healthy={healthy}")
         perf_items.insert(1, f"unhealthy={unhealthy}")
+        perf_items.append(f"monitors_time={elapsed:.3f}s")
         perfdata = " ".join(perf_items)
 
         if bad:
@@ -90,14 +265,136 @@ def check_cameras(base_url, token):
         if good:
             print("OK - All enabled cameras are healthy:\n" + "\n".join(good) + f"\n| {perfdata}")
             return 0
-        print("WARNING - No enabled cameras found\n| healthy=0 unhealthy=0")
+        print(f"WARNING - No enabled cameras found\n| healthy=0 unhealthy=0 monitors_time={elapsed:.3f}s")
         return 1
 
+    except LoginError:
+        raise
     except Exception as e:
         print(f"UNKNOWN - Error checking cameras: {e}")
         return 3
 
 
+def aggregate_events(data, per_monitor):
+    """Add the events of one page to per_monitor (id -> [count, bytes]), returns the pagination."""
+    for entry in data.get("events", []):
+        ev = entry.get("Event", {})
+        counts = per_monitor.setdefault(str(ev.get("MonitorId", "")), [0, 0])
+        counts[0] += 1
+        counts[1] += int(ev.get("DiskSpace") or 0)
+    return data.get("pagination", {})
+
+
+def walk_events(base_url, token, since, workers=4, limit=100):
+    """
+    Count the events started since the given local time per monitor.
+
+    The first page tells how many there are, the others are fetched with at
+    most `workers` requests in flight and folded into the counters as they
+    arrive, so only those pages are in memory and never the whole window.
+    """
+    path = "/events/index/" + quote(f"StartDateTime >=:{since}") + ".json"
+    # Oldest first, events created during the walk end up on the last pages instead of shifting the others
+    params = {"limit": limit, "sort": "Id", "direction": "asc"}
+    per_monitor = {}
+    data, _ = api_get(base_url, path, token, dict(params, page=1))
+    pages = int(aggregate_events(data, per_monitor).get("pageCount") or 1)
+    del data
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        next_page = 2
+        while next_page <= pages or pending:
+            while next_page <= pages and len(pending) < workers:
+                pending.add(pool.submit(api_get, base_url, path, token, dict(params, page=next_page)))
+                next_page += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                aggregate_events(future.result()[0], per_monitor)
+    return per_monitor
+
+
+def check_events(base_url, token, window=3600, workers=4, limit=100, events_thresholds=(100, 300),
+                 disk_thresholds=(80, 90), cache_file=None, ttl=0):
+    """Alert on monitors recording more than events_thresholds events per hour and on full storage areas."""
+    try:
+        start = time.monotonic()
+        since = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - window))
+        # Storage and monitor names are fetched while the events are walked
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            storage = pool.submit(api_get, base_url, "/storage.json", token)
+            monitors = pool.submit(get_monitors, base_url, token, cache_file, ttl)
+            per_monitor = walk_events(base_url, token, since, workers, limit)
+            storage_data = storage.result()[0]
+            names = {str(entry.get("Monitor", {}).get("Id")): entry.get("Monitor", {}).get("Name", "Unknown")
+                     for entry in monitors.result()[0].get("monitors", [])}
+        elapsed = time.monotonic() - start
+
+        status = 0
+        problems = []
+        lines = []
+        perf_items = []
+        hours = window / 3600
+
+        total = 0
+        for mid, (count, size) in sorted(per_monitor.items(), key=lambda item: -item[1][0]):
+            name = names.get(mid, f"Monitor {mid}")
+            rate = count / hours
+            total += count
+            key = re.sub(r"\W+", "_", name)
+            perf_items.append(f"{key}_events_per_hour={rate:.1f};{events_thresholds[0]:g};{events_thresholds[1]:g};0")
+            perf_items.append(f"{key}_events_size={size / BYTES_IN_MB:.1f}MB")
+            line = f"{name}: {count} events ({rate:.1f}/h), {size / BYTES_IN_MB:.1f}MB"
+            if rate >= events_thresholds[1]:
+                status = 2
+                problems.append(f"{name} {rate:.1f} events/h")
+                lines.append(f"[BAD] {line}")
+            elif rate >= events_thresholds[0]:
+                status = max(status, 1)
+                problems.append(f"{name} {rate:.1f} events/h")
+                lines.append(f"[WARN] {line}")
+            else:
+                lines.append(f"[GOOD] {line}")
+
+        for entry in storage_data.get("storage", []):
+            st = entry.get("Storage", {})
+            name = st.get("Name", "Unknown")
+            try:
+                used = int(st["DiskUsedSpace"])
+                disk_total = int(st["DiskTotalSpace"])
+                pct = used * 100 / disk_total
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                # ZoneMinder has not measured this storage area yet
+                continue
+            key = re.sub(r"\W+", "_", name)
+            perf_items.append(f"storage_{key}={pct:.1f}%;{disk_thresholds[0]:g};{disk_thresholds[1]:g};0;100")
+            line = (f"Storage {name}: {pct:.1f}% used ({used / BYTES_IN_GB:.1f} of "
+                    f"{disk_total / BYTES_IN_GB:.1f}GB)")
+            if pct >= disk_thresholds[1]:
+                status = 2
+                problems.append(f"storage {name} {pct:.1f}% used")
+                lines.append(f"[BAD] {line}")
+            elif pct >= disk_thresholds[0]:
+                status = max(status, 1)
+                problems.append(f"storage {name} {pct:.1f}% used")
+                lines.append(f"[WARN] {line}")
+            else:
+                lines.append(f"[GOOD] {line}")
+
+        perf_items.insert(0, f"events={total}")
+        perf_items.append(f"events_time={elapsed:.3f}s")
+        perfdata = " ".join(perf_items)
+        summary = ", ".join(problems) if problems else f"{total} events in the last {hours:g}h, storage below thresholds"
+        print(f"{['OK', 'WARNING', 'CRITICAL'][status]} - {summary}\n" + "\n".join(lines) + f"\n| {perfdata}")
+        return status
+
+    except LoginError:
+        raise
+    except Exception as e:
+        print(f"UNKNOWN - Error checking events: {e}")
+        return 3
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Check ZoneMinder daemon & camera status via API",
@@ -115,23 +412,76 @@ Examples:
   # Cameras only:
   check_zoneminder.py --mode cameras --base-url https://server/zm/api \
                      --username user --password pass
+
+  # Events per camera in the last hour and disk usage of the storage areas:
+  check_zoneminder.py --mode events --base-url https://server/zm/api \
+                     --username user --password pass --events-warning 100 --events-critical 300
+
+  # One camera, by name or id, all camera services share one monitors.json per --monitors-ttl:
+  check_zoneminder.py --monitor Entrance --base-url https://server/zm/api \
+                     --username user --password pass
 """
     )
-    parser.add_argument("--mode", choices=["daemon","cameras","all"], default="all",
+    parser.add_argument("--mode", choices=["daemon","cameras","all","events"], default="all",
                         help="Which check to run")
     parser.add_argument("--base-url", required=True,
                         help="ZoneMinder API base URL (e.g., https://server/zm/api)")
     parser.add_argument("--username", required=True, help="API username")
     parser.add_argument("--password", required=True, help="API password")
+    parser.add_argument("--token-cache", default=os.path.join(tempfile.gettempdir(), f"check_zoneminder-{os.getuid()}.tokens"),
+                        help="File keeping access and refresh tokens between runs")
+    parser.add_argument("--no-token-cache", action="store_true", help="Log in on every run")
+    parser.add_argument("--monitor", help="Check only this camera (name or id), overrides --mode")
+    parser.add_argument("--monitors-cache", default=os.path.join(tempfile.gettempdir(), f"check_zoneminder-{os.getuid()}.monitors"),
+                        help="File sharing the monitors.json snapshot between checks")
+    parser.add_argument("--monitors-ttl", type=float, default=None,
+                        help="Seconds a monitors.json snapshot is used by all camera checks, 0 to fetch every time "
+                             "(default 30 with --monitor, 0 otherwise)")
+    parser.add_argument("--events-window", type=float, default=3600,
+                        help="Seconds of events --mode events looks at (default 3600)")
+    parser.add_argument("--events-warning", type=float, default=100, help="Events per hour and camera for WARNING (default 100)")
+    parser.add_argument("--events-critical", type=float, default=300, help="Events per hour and camera for CRITICAL (default 300)")
+    parser.add_argument("--disk-warning", type=float, default=80, help="Storage usage in percent for WARNING (default 80)")
+    parser.add_argument("--disk-critical", type=float, default=90, help="Storage usage in percent for CRITICAL (default 90)")
+    parser.add_argument("--workers", type=int, default=4, help="Event pages fetched at the same time (default 4)")
+    parser.add_argument("--page-size", type=int, default=100, help="Events per page (default 100)")
     args = parser.parse_args()
+    if args.monitors_ttl is None:
+        # Only the per-camera services share a snapshot unless asked, the other modes stay live
+        args.monitors_ttl = 30 if args.monitor is not None else 0
+
+    # --mode events fetches --workers event pages, storage.json and monitors.json at the same time
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, args.workers) + 2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
-    token = get_token(args.base_url, args.username, args.password)
+    token_cache = None if args.no_token_cache else args.token_cache
+    token_source = lambda refused: get_token(args.base_url, args.username, args.password, token_cache, refused)
 
-    if args.mode == "daemon":
-        sys.exit(check_daemon(args.base_url, token))
-    elif args.mode == "cameras":
-        sys.exit(check_cameras(args.base_url, token))
-    else:
-        d = check_daemon(args.base_url, token)
-        c = check_cameras(args.base_url, token)
-        sys.exit(max(d, c))
+    try:
+        token = get_token(args.base_url, args.username, args.password, token_cache)
+        if args.monitor is not None:
+            status = check_monitor(args.base_url, token, args.monitor, args.monitors_cache, args.monitors_ttl)
+        elif args.mode == "daemon":
+            status = check_daemon(args.base_url, token)
+        elif args.mode == "events":
+            status = check_events(args.base_url, token, args.events_window, max(1, args.workers), args.page_size,
+                                  (args.events_warning, args.events_critical), (args.disk_warning, args.disk_critical),
+                                  args.monitors_cache, args.monitors_ttl)
+        elif args.mode == "cameras":
+            status = check_cameras(args.base_url, token, args.monitors_cache, args.monitors_ttl)
+        else:
+            # Both API calls run at the same time, the results are printed in the usual order
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                daemon = pool.submit(api_get, args.base_url, "/host/daemonCheck.json", token)
+                monitors = pool.submit(get_monitors, args.base_url, token, args.monitors_cache, args.monitors_ttl)
+                # A failed login replaces both results, nothing is printed before it is known
+                for future in wait([daemon, monitors]).done:
+                    if isinstance(future.exception(), LoginError):
+                        raise future.exception()
+                status = max(check_daemon(args.base_url, token, daemon),
+                             check_cameras(args.base_url, token, prefetched=monitors))
+    except LoginError as e:
+        print(e)
+        sys.exit(e.status)
+    sys.exit(status)
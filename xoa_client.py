@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Xen Orchestra REST client shared by the XOA checks
+#
+# Keeps one requests.Session so all requests of a check reuse the same
+# keep-alive connections, retries 5xx answers and timeouts with backoff and
+# raises XoError subclasses instead of exiting, the checks decide what to print.
+
+import codecs
+import json
+import re
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+XoApiUri = '/rest/v0'
+
+
+class XoError(Exception):
+    pass
+
+class XoTimeout(XoError):
+    pass
+
+class XoConnectionError(XoError):
+    pass
+
+class XoHttpError(XoError):
+    def __init__(self, Message, StatusCode):
+        XoError.__init__(self, Message)
+        self.status_code = StatusCode
+
+class XoNotFound(XoHttpError):
+    pass
+
+
+def queryParams(Fields = None, Filter = None, Limit = None):
+    # fields= takes a comma separated list, filter= XO's complex matcher syntax, e.g. !"tags":"no_monitoring"
+    Params = {}
+    if Fields:
+        Params['fields'] = Fields if isinstance(Fields, str) else ','.join(Fields)
+    if Filter:
+        Params['filter'] = Filter
+    if Limit is not None:
+        Params['limit'] = str(Limit)
+    return Params
+
+
+JsonSeparators = re.compile(r'[\s,]*')
+
+def iterJsonArray(Chunks):
+    # Yields the elements of a JSON array arriving as text chunks, only the
+    # element being parsed is held in memory instead of the whole document
+    Decoder = json.JSONDecoder()
+    Buffer = ''
+    Started = False
+    for Chunk in Chunks:
+        Buffer += Chunk
+        Position = 0
+        while True:
+            if not Started:
+                Position = JsonSeparators.match(Buffer, Position).end() if Buffer[Position:Position + 1].isspace() else Position
+                if Position == len(Buffer):
+                    break
+                if Buffer[Position] != '[':
+                    raise XoError('Invalid JSON: array expected')
+                Started = True
+                Position += 1
+            Position = JsonSeparators.match(Buffer, Position).end()
+            if Position == len(Buffer):
+                break
+            if Buffer[Position] == ']':
+                return
+            try:
+                Element, End = Decoder.raw_decode(Buffer, Position)
+            except ValueError:
+                break
+            if End == len(Buffer) or Buffer[End] not in ' \t\r\n,]':
+                # A number cut by the chunk end ("2.5e" of "2.5e3") decodes as well, wait for its end
+                break
+            yield Element
+            Position = End
+        Buffer = Buffer[Position:]
+    raise XoError('Invalid JSON: ' + ('truncated array' if Started else 'empty answer'))
+
+
+class XoClient:
+    def __init__(self, Protocol, Url, Token, Timeout = 10, Retries = 2, Backoff = 0.5, PoolSize = 10):
+        self.base_url = str(Protocol) + '://' + str(Url) + XoApiUri
+        self.timeout = Timeout
+        self.session = requests.Session()
+        self.session.cookies.set('authenticationToken', str(Token))
+        # Only idempotent requests are retried, a POST may have been carried out already
+        RetryPolicy = Retry(total=Retries, connect=Retries, read=Retries, status=Retries,
+                            backoff_factor=Backoff, status_forcelist=(500, 502, 503, 504),
+                            allowed_methods=frozenset(('GET', 'HEAD')), raise_on_status=False)
+        Adapter = HTTPAdapter(pool_connections=PoolSize, pool_maxsize=PoolSize, max_retries=RetryPolicy)
+        self.session.mount('http://', Adapter)
+        self.session.mount('https://', Adapter)
+
+    def path(self, Href):
+        # Collections return hrefs like /rest/v0/pools/<id>, accept those as well as plain paths
+        Href = str(Href)
+        if Href.startswith(XoApiUri):
+            Href = Href[len(XoApiUri):]
+        return Href
+
+    def request(self, Method, ApiUri, Params = None, Timeout = None, Stream = False):
+        try:
+            req = self.session.request(Method, self.base_url + self.path(ApiUri), params=Params, stream=Stream,
+                                       timeout=self.timeout if Timeout is None else Timeout)
+        except requests.Timeout:
+            raise XoTimeout('Timeout')
+        except requests.exceptions.RetryError as ex:
+            raise XoHttpError(str(ex), 0)
+        except requests.ConnectionError as ex:
+            raise XoConnectionError(str(ex))
+
+        if req.status_code == 404:
+            raise XoNotFound(str(req.status_code) + ' Not Found: ' + req.url, req.status_code)
+        try:
+            req.raise_for_status()
+        except requests.HTTPError as ex:
+            raise XoHttpError(str(ex), req.status_code)
+        return req
+
+    def get(self, ApiUri, Fields = None, Filter = None, Limit = None, Timeout = None):
+        req = self.request('GET', ApiUri, queryParams(Fields, Filter, Limit), Timeout)
+        try:
+            return req.json()
+        except ValueError:
+            raise XoError('Invalid JSON from ' + req.url)
+
+    def iterate(self, ApiUri, Fields = None, Filter = None, Limit = None, Timeout = None):
+        # Like get() for collections, but yields the objects while the answer is still arriving
+        req = self.request('GET', ApiUri, queryParams(Fields, Filter, Limit), Timeout, Stream=True)
+        Decoder = codecs.getincrementaldecoder(req.encoding or 'utf-8')(errors='replace')
+        try:
+            yield from iterJsonArray(Decoder.decode(Chunk) for Chunk in req.iter_content(65536))
+        except requests.Timeout:
+            raise XoTimeout('Timeout')
+        except requests.RequestException as ex:
+            raise XoConnectionError(str(ex))
+        finally:
+            req.close()
+
+    def getText(self, ApiUri, Fields = None, Filter = None, Limit = None, Timeout = None):
+        return self.request('GET', ApiUri, queryParams(Fields, Filter, Limit), Timeout).text
+
+    def post(self, ApiUri, Timeout = None):
+        return self.request('POST', ApiUri, None, Timeout).text
+
+    def close(self):
+        self.session.close()
+
+
+def readSnapshot(Path, MaxAge):
+    # Object cache written by xoa_events.py, refused once the daemon stopped updating it
+    try:
+        with open(Path) as f:
+            Snapshot = json.load(f)
+        Age = time.time() - float(Snapshot['time'])
+        if not isinstance(Snapshot.get('objects'), dict):
+            raise ValueError('no objects')
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as ex:
+        raise XoError('Cannot read snapshot ' + str(Path) + ': ' + str(ex))
+    if Age > MaxAge:
+        raise XoError('Snapshot ' + str(Path) + ' is ' + '{:.0f}'.format(Age) + 's old, is xoa_events.py running?')
+    return Snapshot
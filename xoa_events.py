@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+# Xen Orchestra object cache for the XOA checks
+#
+# Connects to the JSON-RPC websocket API of XO, loads all SRs, pools and hosts
+# once with xo.getAllObjects and keeps them current from the "all" events XO
+# pushes afterwards. The objects are written to a snapshot file every few
+# seconds, check_xoa_srs.py and check_xoa_pools_patches.py read it with
+# --snapshot instead of walking the REST API. Missing patches are not part of
+# the object stream, they are listed per pool every --patch-interval seconds.
+#
+# Run it as a service, e.g.
+#   xoa_events.py --protocol https --url xo.example.com --token <token> --snapshot /var/tmp/xoa.json
+#
+# xoa_events.py --selftest runs the daemon code against FakeXo, a local
+# stand-in for the XO websocket API, no XO needed.
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+from urllib.parse import urlsplit
+
+#    User Vars
+Debug = False
+
+#    Script Vars - do not edit
+XoTypes = {
+    'SR':   ('id', 'name_label', '$container', '$pool', 'size', 'usage', 'physical_usage', 'content_type', 'SR_type', 'tags'),
+    'pool': ('id', 'name_label', 'master', 'tags'),
+    'host': ('id', 'name_label', '$pool', 'power_state', 'tags'),
+}
+
+Timeout = 30
+
+
+class WebSocketClosed(Exception):
+    pass
+
+class RpcError(Exception):
+    pass
+
+
+class WebSocket:
+    # Just enough of RFC 6455 for a JSON-RPC client: text messages, fragments, ping and close
+
+    def __init__(self, Url, Timeout = Timeout, VerifyTls = True):
+        Parts = urlsplit(Url)
+        Port = Parts.port or (443 if Parts.scheme == 'wss' else 80)
+        Sock = socket.create_connection((Parts.hostname, Port), timeout=Timeout)
+        if Parts.scheme == 'wss':
+            Context = ssl.create_default_context()
+            if not VerifyTls:
+                Context.check_hostname = False
+                Context.verify_mode = ssl.CERT_NONE
+            Sock = Context.wrap_socket(Sock, server_hostname=Parts.hostname)
+        self.sock = Sock
+        self.send_lock = threading.Lock()
+        # bytearray, appending to and cutting from it does not copy the whole multi-MB answers
+        self.buffer = bytearray()
+
+        Key = base64.b64encode(os.urandom(16)).decode()
+        Request = ('GET ' + (Parts.path or '/') + ' HTTP/1.1\r\n'
+                   'Host: ' + Parts.netloc + '\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: ' + Key + '\r\n'
+                   'Sec-WebSocket-Version: 13\r\n\r\n')
+        Sock.sendall(Request.encode())
+        while b'\r\n\r\n' not in self.buffer:
+            self.buffer += self.recvSome()
+        Header, Rest = self.buffer.split(b'\r\n\r\n', 1)
+        self.buffer = bytearray(Rest)
+        StatusLine = bytes(Header.split(b'\r\n', 1)[0]).decode('latin-1')
+        if StatusLine.split(' ')[1:2] != ['101']:
+            raise WebSocketClosed('Handshake failed: ' + StatusLine)
+        # Events may be minutes apart, only connecting and sending are bounded
+        Sock.settimeout(None)
+
+    def recvSome(self):
+        Data = self.sock.recv(65536)
+        if not Data:
+            raise WebSocketClosed('Connection closed')
+        return Data
+
+    def recvExactly(self, Length):
+        while len(self.buffer) < Length:
+            self.buffer += self.recvSome()
+        Data = bytes(self.buffer[:Length])
+        del self.buffer[:Length]
+        return Data
+
+    def sendFrame(self, Opcode, Payload):
+        Header = bytes([0x80 | Opcode])
+        if len(Payload) < 126:
+            Header += bytes([0x80 | len(Payload)])
+        elif len(Payload) < 65536:
+            Header += bytes([0x80 | 126]) + struct.pack('!H', len(Payload))
+        else:
+            Header += bytes([0x80 | 127]) + struct.pack('!Q', len(Payload))
+        # Clients have to mask every frame
+        Mask = os.urandom(4)
+        Masked = self.mask(Payload, Mask)
+        with self.send_lock:
+            self.sock.sendall(Header + Mask + Masked)
+
+    @staticmethod
+    def mask(Payload, Mask):
+        if not Payload:
+            return b''
+
+        # XOR with the repeated key through one big integer, much faster than per byte
+        Length = len(Payload)
+        Key = (Mask * (Length // 4 + 1))[:Length]
+        return (int.from_bytes(Payload, 'big') ^ int.from_bytes(Key, 'big')).to_bytes(Length, 'big')
+
+    def send(self, Text):
+        self.sendFrame(0x1, Text.encode())
+
+    def recv(self):
+        # Returns the next text message, answers pings on the way
+        Message = bytearray()
+        while True:
+            First, Second = self.recvExactly(2)
+            Opcode = First & 0x0f
+            Length = Second & 0x7f
+            if Length == 126:
+                Length = struct.unpack('!H', self.recvExactly(2))[0]
+            elif Length == 127:
+                Length = struct.unpack('!Q', self.recvExactly(8))[0]
+            Mask = self.recvExactly(4) if Second & 0x80 else None
+            Payload = self.recvExactly(Length)
+            if Mask is not None:
+                Payload = self.mask(Payload, Mask)
+            if Opcode == 0x8:
+                raise WebSocketClosed('Closed by server')
+            if Opcode == 0x9:
+                self.sendFrame(0xa, Payload)
+                continue
+            if Opcode == 0xa:
+                continue
+            Message += Payload
+            if First & 0x80:
+                return Message.decode()
+
+    def close(self):
+        try:
+            self.sendFrame(0x8, b'')
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class XoObjectCache:
+    def __init__(self, Url, Token, VerifyTls = True):
+        self.url = Url
+        self.token = Token
+        self.verify_tls = VerifyTls
+        self.lock = threading.Lock()
+        self.objects = {Type: {} for Type in XoTypes}
+        self.missing_patches = {}
+        self.loaded = None
+        self.backlog = None
+        self.ws = None
+        self.calls = {}
+        self.next_id = 0
+
+    def connect(self):
+        self.ws = WebSocket(self.url, VerifyTls=self.verify_tls)
+        self.calls = {}
+        # Events arriving while the objects are loaded are applied on top of them afterwards
+        self.backlog = []
+        self.reader = threading.Thread(target=self.readLoop, daemon=True)
+        self.reader.start()
+        self.call('session.signIn', {'token': self.token})
+        Objects = {Type: {} for Type in XoTypes}
+        for Type in XoTypes:
+            for Object in self.call('xo.getAllObjects', {'filter': {'type': Type}}).values():
+                Objects[Type][Object['id']] = self.strip(Object)
+        with self.lock:
+            self.objects = Objects
+            self.loaded = time.time()
+            for Params in self.backlog:
+                self.applyItems(Params)
+            self.backlog = None
+        debugPrint('loaded ' + ', '.join(str(len(Objects[Type])) + ' ' + Type for Type in XoTypes))
+
+    def alive(self):
+        return self.ws is not None and self.reader.is_alive()
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+    def call(self, Method, Params, CallTimeout = Timeout):
+        with self.lock:
+            self.next_id += 1
+            CallId = self.next_id
+            Pending = self.calls[CallId] = {'done': threading.Event()}
+        self.ws.send(json.dumps({'jsonrpc': '2.0', 'id': CallId, 'method': Method, 'params': Params}))
+        if not Pending['done'].wait(CallTimeout):
+            self.calls.pop(CallId, None)
+            raise RpcError(Method + ': timeout')
+        if 'error' in Pending:
+            raise RpcError(Method + ': ' + str(Pending['error'].get('message', Pending['error'])))
+        return Pending['result']
+
+    def readLoop(self):
+        try:
+            while True:
+                Message = json.loads(self.ws.recv())
+                if 'id' in Message and Message['id'] in self.calls:
+                    Pending = self.calls.pop(Message['id'])
+                    if 'error' in Message:
+                        Pending['error'] = Message['error']
+                    else:
+                        Pending['result'] = Message.get('result')
+                    Pending['done'].set()
+                elif Message.get('method') == 'all':
+                    self.applyEvent(Message['params'])
+        except (OSError, ValueError, KeyError, AttributeError, WebSocketClosed) as ex:
+            debugPrint('connection lost: ' + str(ex))
+        finally:
+            # Wake up calls waiting for an answer that will never come
+            for Pending in list(self.calls.values()):
+                Pending['error'] = {'message': 'connection lost'}
+                Pending['done'].set()
+
+    @staticmethod
+    def strip(Object):
+        return {Key: Object[Key] for Key in XoTypes[Object['type']] if Key in Object}
+
+    def applyEvent(self, Params):
+        with self.lock:
+            if self.backlog is not None:
+                self.backlog.append(Params)
+            else:
+                self.applyItems(Params)
+
+    def applyItems(self, Params):
+        # "enter" carries new and changed objects, "exit" removed ones, the caller holds the lock
+        for ObjectId, Object in Params.get('items', {}).items():
+            Type = Object.get('type')
+            if Type not in XoTypes:
+                continue
+            if Params.get('type') == 'exit':
+                self.objects[Type].pop(ObjectId, None)
+            else:
+                self.objects[Type][ObjectId] = self.strip(Object)
+
+    def refreshMissingPatches(self):
+        with self.lock:
+            Pools = list(self.objects['pool'].values())
+        for Pool in Pools:
+            if not Pool.get('master'):
+                continue
+            try:
+                Patches = self.call('pool.listMissingPatches', {'host': Pool['master']}, CallTimeout=300)
+            except (RpcError, OSError) as ex:
+                debugPrint(Pool['name_label'] + ': ' + str(ex))
+                continue
+            with self.lock:
+                self.missing_patches[Pool['id']] = {'time': time.time(), 'count': len(Patches)}
+
+    def writeSnapshot(self, Path):
+        with self.lock:
+            Snapshot = json.dumps({
+                'time': time.time(),
+                'loaded': self.loaded,
+                'objects': self.objects,
+                'missing_patches': self.missing_patches,
+            })
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(Path)), delete=False) as f:
+            f.write(Snapshot)
+        os.replace(f.name, Path)
+
+
+class FakeXo:
+    # Stand-in for the websocket API of XO on a local port. It answers the calls of
+    # XoObjectCache, sends an event while the SRs are loaded and another one after
+    # the load. A pool has as many missing patches as its number in the name.
+
+    def __init__(self, Srs = 20000, Pools = 5):
+        self.objects = {'SR': {}, 'pool': {}, 'host': {}}
+        for i in range(Pools):
+            self.objects['pool']['pool' + str(i)] = {'id': 'pool' + str(i), 'type': 'pool', 'name_label': 'Pool ' + str(i), 'master': 'host' + str(i)}
+            self.objects['host']['host' + str(i)] = {'id': 'host' + str(i), 'type': 'host', 'name_label': 'Host ' + str(i), '$pool': 'pool' + str(i), 'power_state': 'Running'}
+        for i in range(Srs):
+            self.objects['SR']['sr' + str(i)] = {'id': 'sr' + str(i), 'type': 'SR', 'name_label': 'SR ' + str(i), '$container': 'pool' + str(i % Pools),
+                                                 'size': 10**12, 'physical_usage': i * 10**7, 'usage': i * 10**7, 'content_type': 'user',
+                                                 'SR_type': 'nfs', 'other_config': {'padding': 'x' * 100}}
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.url = 'ws://127.0.0.1:' + str(self.listener.getsockname()[1]) + '/api/'
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def send(self, Conn, Message):
+        Payload = json.dumps(Message).encode()
+        if len(Payload) < 126:
+            Header = bytes([0x81, len(Payload)])
+        elif len(Payload) < 65536:
+            Header = bytes([0x81, 126]) + struct.pack('!H', len(Payload))
+        else:
+            Header = bytes([0x81, 127]) + struct.pack('!Q', len(Payload))
+        Conn.sendall(Header + Payload)
+
+    def event(self, Conn, Type, Object):
+        self.send(Conn, {'jsonrpc': '2.0', 'method': 'all', 'params': {'type': Type, 'items': {Object['id']: Object}}})
+
+    def serve(self):
+        Conn, Address = self.listener.accept()
+        Reader = Conn.makefile('rb')
+        Request = b''
+        while not Request.endswith(b'\r\n\r\n'):
+            Request += Reader.readline()
+        Key = [Line.split(b':', 1)[1].strip() for Line in Request.split(b'\r\n') if Line.lower().startswith(b'sec-websocket-key:')][0]
+        Accept = base64.b64encode(hashlib.sha1(Key + b'258EAFA5-E914-47DA-95CA-C5AB0DC11B85').digest())
+        Conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + Accept + b'\r\n\r\n')
+        try:
+            while True:
+                First, Second = Reader.read(2)
+                Length = Second & 0x7f
+                if Length == 126:
+                    Length = struct.unpack('!H', Reader.read(2))[0]
+                elif Length == 127:
+                    Length = struct.unpack('!Q', Reader.read(8))[0]
+                Mask = Reader.read(4)
+                Payload = WebSocket.mask(Reader.read(Length), Mask)
+                if First & 0x0f == 0x8:
+                    break
+                Call = json.loads(Payload)
+                Result = True
+                if Call['method'] == 'xo.getAllObjects':
+                    Type = Call['params']['filter']['type']
+                    if Type == 'SR':
+                        # Changes while the SRs are loaded, have to be replayed on top of them
+                        self.event(Conn, 'enter', {'id': 'sr-new', 'type': 'SR', 'name_label': 'SR new'})
+                        self.event(Conn, 'exit', {'id': 'sr0', 'type': 'SR'})
+                    Result = self.objects[Type]
+                elif Call['method'] == 'pool.listMissingPatches':
+                    Result = [{}] * int(Call['params']['host'][len('host'):])
+                self.send(Conn, {'jsonrpc': '2.0', 'id': Call['id'], 'result': Result})
+                if Call['method'] == 'xo.getAllObjects' and Call['params']['filter']['type'] == 'host':
+                    self.event(Conn, 'enter', dict(self.objects['pool']['pool1'], name_label='Pool 1 renamed'))
+        except (OSError, ValueError):
+            pass
+        Conn.close()
+
+
+def selftest(Srs = 20000):
+    # Loads FakeXo's objects, applies its events and writes a snapshot, returns True if all passed
+    Server = FakeXo(Srs)
+    Cache = XoObjectCache(Server.url, 'token')
+    Start = time.perf_counter()
+    Cache.connect()
+    LoadTime = time.perf_counter() - Start
+    Cache.refreshMissingPatches()
+    for _ in range(50):
+        if Cache.objects['pool']['pool1']['name_label'] == 'Pool 1 renamed':
+            break
+        time.sleep(0.1)
+    with tempfile.TemporaryDirectory() as Dir:
+        Cache.writeSnapshot(os.path.join(Dir, 'snapshot.json'))
+        with open(os.path.join(Dir, 'snapshot.json')) as f:
+            Snapshot = json.load(f)
+    Cache.close()
+
+    Srs = Snapshot['objects']['SR']
+    Checks = [
+        ('objects loaded', len(Srs) == len(Server.objects['SR']) and len(Snapshot['objects']['host']) == 5),
+        ('events during load replayed', 'sr-new' in Srs and 'sr0' not in Srs),
+        ('events after load applied', Snapshot['objects']['pool']['pool1']['name_label'] == 'Pool 1 renamed'),
+        ('objects stripped', 'other_config' not in Srs['sr1'] and Srs['sr1']['size'] == 10**12),
+        ('missing patches listed', {Id: Entry['count'] for Id, Entry in Snapshot['missing_patches'].items()} == {'pool' + str(i): i for i in range(5)}),
+    ]
+    for Name, Ok in Checks:
+        print('{:<30} {}'.format(Name, 'ok' if Ok else 'FAILED'))
+    print('load: {} SRs in {:.2f}s'.format(len(Server.objects['SR']), LoadTime))
+    return all(Ok for Name, Ok in Checks)
+
+
+def debugPrint(Text):
+    if Debug == True:
+        print('[DEBUG] ' + Text, file=sys.stderr, flush=True)
+
+def parse_opts():
+    parser = OptionParser()
+    parser.add_option("--protocol")
+    parser.add_option("--url")
+    parser.add_option("--token")
+    parser.add_option("--snapshot", help="file the object cache is written to")
+    parser.add_option("--snapshot-interval", dest="snapshot_interval", type="float", default=10,
+                      help="seconds between two snapshots (default 10)")
+    parser.add_option("--patch-interval", dest="patch_interval", type="float", default=3600,
+                      help="seconds between two missing patch listings, 0 to disable (default 3600)")
+    parser.add_option("--insecure", action="store_true", help="do not verify the TLS certificate of XO")
+    parser.add_option("--debug", action="store_true")
+    parser.add_option("--selftest", action="store_true", help="run against a local stand-in for XO and exit")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    (options, args) = parse_opts()
+    if options.selftest:
+        exit(0 if selftest() else 1)
+    if not (options.protocol and options.url and options.token and options.snapshot):
+        print('--protocol, --url, --token and --snapshot are required')
+        exit(3)
+    Debug = Debug or options.debug
+
+    XoWsUrl = ('wss' if options.protocol == 'https' else 'ws') + '://' + str(options.url) + '/api/'
+    Cache = XoObjectCache(XoWsUrl, options.token, VerifyTls=not options.insecure)
+    Backoff = 1
+    while True:
+        try:
+            Cache.connect()
+            Backoff = 1
+            NextPatches = time.monotonic()
+            while Cache.alive():
+                # The heartbeat in the snapshot tells the checks the daemon is still connected
+                Cache.writeSnapshot(options.snapshot)
+                if options.patch_interval > 0 and time.monotonic() >= NextPatches:
+                    NextPatches = time.monotonic() + options.patch_interval
+                    threading.Thread(target=Cache.refreshMissingPatches, daemon=True).start()
+                Cache.reader.join(options.snapshot_interval)
+        except (OSError, RpcError, WebSocketClosed) as ex:
+            debugPrint('error: ' + str(ex))
+        except KeyboardInterrupt:
+            Cache.close()
+            exit(0)
+        Cache.close()
+        time.sleep(Backoff)
+        Backoff = min(Backoff * 2, 60)